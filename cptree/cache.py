@@ -0,0 +1,138 @@
+# persistent checksum cache
+
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+CACHE_FILE = "cptree.cache"
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+CACHE_TIMEOUT = 60
+CACHE_BATCH_SIZE = 1000
+CACHE_VACUUM_RATIO = 0.25
+
+# files modified this recently may still change within the timestamp granularity
+RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path BLOB NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (path, hash)
+) WITHOUT ROWID
+"""
+
+
+def cache_file(output_dir):
+    """return the checksum cache filename kept next to output_dir, so reports copied from it leave the cache out"""
+    output_dir = Path(output_dir).resolve()
+    return output_dir.with_name(f"{output_dir.name}.{CACHE_FILE}")
+
+
+class ChecksumCache:
+    """on-disk file digest cache keyed by path, size, mtime_ns, inode and hash algorithm
+
+    The database runs in WAL mode with a busy timeout, so several cptree
+    processes may share one cache file.  Entries unused for max_age seconds
+    are evicted when the cache is closed.
+    """
+
+    def __init__(self, filename, max_age=CACHE_MAX_AGE):
+        self.filename = str(filename)
+        self.max_age = max_age
+        self.db = sqlite3.connect(self.filename, timeout=CACHE_TIMEOUT, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.now = int(time.time())
+        self.pending = {}
+        self.updates = []
+        self.hits = []
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def filter(self, base, names, hashes, hit_callback):
+        """yield names whose cached digests are missing or stale, passing (name, digests) of valid entries to hit_callback"""
+        for name in names:
+            path = os.fsencode(os.path.normpath(os.path.join(base, name)))
+            try:
+                stat = os.stat(path, follow_symlinks=False)
+            except OSError:
+                yield name
+                continue
+            key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            digests = []
+            for hash in hashes:
+                row = self.db.execute(
+                    "SELECT size, mtime_ns, inode, digest FROM digests WHERE path=? AND hash=?", (path, hash)
+                ).fetchone()
+                if not row or tuple(row[:3]) != key:
+                    break
+                digests.append(row[3])
+            if len(digests) == len(hashes):
+                self.hit_count += 1
+                self.hits.extend((self.now, path, hash) for hash in hashes)
+                if len(self.hits) >= CACHE_BATCH_SIZE:
+                    self.flush()
+                hit_callback(name, digests)
+            else:
+                self.miss_count += 1
+                self.pending[name] = (path, stat)
+                yield name
+
+    def update(self, name, hashes, digests):
+        """record digests computed for a name yielded by filter"""
+        entry = self.pending.pop(name, None)
+        if entry is None:
+            return
+        path, stat = entry
+        if time.time_ns() - stat.st_mtime_ns < RACY_INTERVAL_NS:
+            return
+        for hash, digest in zip(hashes, digests):
+            self.updates.append((path, hash, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest, self.now))
+        if len(self.updates) >= CACHE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """write queued updates in a single transaction"""
+        if not (self.updates or self.hits):
+            return
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)", self.updates)
+            self.db.executemany("UPDATE digests SET used=? WHERE path=? AND hash=?", self.hits)
+        self.updates = []
+        self.hits = []
+
+    def evict(self):
+        """delete entries unused for max_age seconds, compacting the file when mostly free pages"""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("DELETE FROM digests WHERE used < ?", (self.now - self.max_age,))
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        if pages and free / pages > CACHE_VACUUM_RATIO:
+            try:
+                self.db.execute("VACUUM")
+            except sqlite3.OperationalError:
+                # another process holds the database; compact on a later run
+                pass
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.evict()
+            self.db.close()
+            self.db = None
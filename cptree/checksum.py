@@ -1,23 +1,49 @@
 # generate checksum for a list of files
 
 import atexit
+import inspect
+import json
+import os
+import re
+import shlex
 import shutil
 from pathlib import Path
 from tempfile import NamedTemporaryFile, mkdtemp
 
 import click
-from invoke import run
 from tqdm import tqdm
 
+from . import hashing
 from .common import host_mode, runner, split_target, which
 from .exceptions import (
     ChecksumCompareFailed,
-    ChecksumExcludeFileGenerationFailed,
     ChecksumGenerationFailed,
 )
-from .exclude import rsync_exclude_patterns
+from .exclude import exclude_filter
+from .hashing import (
+    AGENT_BOOTSTRAP,
+    STAT_HASH,
+    hash_files,
+    hash_tag,
+    is_flat_hash,
+    is_sampled_hash,
+    is_tree_hash,
+    tag_line,
+    walk_files,
+)
+from .preflight import preflight
+from .process import run, start
+from .progress import ProgressAggregator
 from .watcher import LineWatcher
 
+HASH_BATCH_SIZE = 256
+HASH_JOBS = "$(nproc 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 4)"
+
+# byte-order collation, so compare_digests can merge both files by key
+SORT_ENV = {"LC_ALL": "C"}
+UNESCAPE_CHARS = {"\\": "\\", "n": "\n", "r": "\r"}
+LIST_FILE_COMMAND = "TEMPFILE=$(mktemp) && cat >$TEMPFILE && echo $TEMPFILE"
+
 
 def is_remote(host):
     return bool(host)
@@ -27,8 +53,31 @@ def is_local(host):
     return not bool(host)
 
 
-def checksum(target, hash, output_file, tqdm_kwargs=None, rsync_args=None, src=None, dst=None):
+def checksum(target, hash, output_file, *args, **kwargs):
     """generate BSD-style checksum for each file in target, returning local file containing result"""
+    return checksums(target, [hash], [output_file], *args, **kwargs)[0]
+
+
+def checksums(
+    target,
+    hashes,
+    output_files,
+    tqdm_kwargs=None,
+    rsync_args=None,
+    src=None,
+    dst=None,
+    cache=None,
+    files=None,
+    quiet=False,
+    agent=False,
+    cancel=None,
+):
+    """generate BSD-style checksums for each file in target, returning local files containing results, one per hash
+
+    If files is given, only those './'-relative names are hashed and excludes are not applied.  If agent is set,
+    remote files are hashed by the hashing module run with the host's python3, if it has one.  Setting the cancel
+    event stops hashing, and ChecksumGenerationFailed is raised.
+    """
 
     if tqdm_kwargs is None:
         tqdm_kwargs = dict(disable=True)
@@ -46,79 +95,306 @@ def checksum(target, hash, output_file, tqdm_kwargs=None, rsync_args=None, src=N
     else:
         raise RuntimeError
 
-    click.echo(f"Generating checksums for {host_mode(host)} {label} {target}")
-
-    # try linux command without breaking
-    hash_cmd = which(hash + "sum", host, quiet=True)
-    if hash_cmd:
-        # add option if linux
-        hash_cmd += " --tag"
+    if not quiet:
+        click.echo(f"Generating checksums for {host_mode(host)} {label} {target}")
+
+    tempfiles = []
+    for hash in hashes:
+        tempfile = NamedTemporaryFile("w+", delete=False, errors="surrogateescape")
+        atexit.register(delete_file, tempfile.name)
+        tempfiles.append(tempfile)
+
+    try:
+        out_streams = [tempfile.file for tempfile in tempfiles]
+        if is_local(host):
+            with ProgressAggregator(tqdm(unit=" lines", **tqdm_kwargs)) as bar:
+                local_checksum(
+                    base, hashes, out_streams, lambda name: bar.update(1), rsync_args, cache, files, cancel
+                )
+        else:
+            remote_checksum(base, host, hashes, out_streams, tqdm_kwargs, rsync_args, files, agent, cancel)
+    finally:
+        for tempfile in tempfiles:
+            tempfile.close()
+
+    # sort checksums into output files
+    for tempfile, output_file in zip(tempfiles, output_files):
+        run(f"{which('sort')} -o {shlex.quote(str(output_file))} {shlex.quote(tempfile.name)}", env=SORT_ENV)
+
+    return output_files
+
+
+def local_checksum(base, hashes, out_streams, file_callback, rsync_args, cache=None, files=None, cancel=None):
+    """hash local files in-process, reading each file once and writing BSD-style lines to one out_stream per hash"""
+    if files is None:
+        names = walk_files(base, exclude_filter(rsync_args), cancel)
     else:
-        # try bsd-style hash command
-        hash_cmd = which(hash, host)
+        names = iter(files)
+    tags = [hash_tag(hash) for hash in hashes]
+
+    def _write(name, digests):
+        for tag, digest, out_stream in zip(tags, digests, out_streams):
+            out_stream.write(tag_line(tag, name, digest) + "\n")
+        file_callback(name)
+
+    if hashes == [STAT_HASH]:
+        cache = None
+
+    if cache is not None:
+        names = cache.filter(base, names, hashes, _write)
+
+    try:
+        for name, digests in hash_files(base, names, hashes, cancel=cancel):
+            _write(name, digests)
+            if cache is not None:
+                cache.update(name, hashes, digests)
+    except OSError as exc:
+        raise ChecksumGenerationFailed(str(exc)) from exc
+    _check_cancel(cancel)
+
+
+def remote_checksum(  # noqa: C901
+    base, host, hashes, out_streams, tqdm_kwargs, rsync_args, files=None, agent=False, cancel=None
+):
+    """hash remote files with the host's checksum commands, one pass per hash, writing BSD-style lines"""
+
+    if agent or needs_agent(hashes):
+        preflight(host, commands=remote_commands(hashes, agent))
+        python = which("python3", host, quiet=True)
+        if python:
+            return agent_checksum(base, host, python, hashes, out_streams, tqdm_kwargs, rsync_args, files, cancel)
+        check_remote_hashes(host, hashes)
+        click.echo(f"WARNING: python3 not available on {host}; hashing with shell commands", err=True)
+
+    preflight(host, commands=remote_commands(hashes))
+    list_filename = ""
+    exclude = exclude_filter(rsync_args) if files is None else None
+    if files is not None:
+        list_filename = generate_list_file(host, files)
+    elif exclude is not None:
+        list_filename = filtered_list_file(base, host, exclude)
+
+    for hash, out_stream in zip(hashes, out_streams):
+
+        with ProgressAggregator(tqdm(unit=" lines", desc=hash if len(hashes) > 1 else None, **tqdm_kwargs)) as bar:
+            if hash == STAT_HASH:
+                # stat output is rewritten locally, so filenames are escaped as in local checksum lines
+                hash_cmd, separator = stat_command(host)
+                out_stream = StatWriter(out_stream, separator, lambda: bar.update(1))
+                watchers = []
+            else:
+                hash_cmd = hash_command(hash, host)
+                watchers = [LineWatcher(line_callback=lambda line: bar.update(1))]
+
+            genproc = runner(host)(
+                checksum_command(base, host, hash_cmd, list_filename=list_filename),
+                warn=True,
+                watchers=watchers,
+                out_stream=out_stream,
+                cancel=cancel,
+            )
+
+        _check_cancel(cancel)
+        if genproc.failed:
+            raise ChecksumGenerationFailed(genproc.stderr)
 
-    exclude_filename = generate_exclude_file(host, rsync_args)
+    if list_filename:
+        delete_remote_file(host, list_filename)
 
-    with NamedTemporaryFile("w+", delete=False) as tempfile:
 
-        with tqdm(unit=" lines", **tqdm_kwargs) as bar:
+def agent_checksum(base, host, python, hashes, out_streams, tqdm_kwargs, rsync_args, files=None, cancel=None):
+    """hash remote files in one pass with the hashing module sent to the host's python over stdin
 
-            atexit.register(delete_file, tempfile.name)
+    The agent walks the tree, or reads the NUL-delimited names of files,
+    hashes them in a worker pool and writes a line per file and hash, which
+    is routed to the out_stream of its hash by its tag.
+    """
+    tags = [hash_tag(hash) for hash in hashes]
+    streams = dict(zip(tags, out_streams))
+    exclude = exclude_filter(rsync_args)
+    exclude = exclude.patterns if exclude else None
+    request = dict(base=str(base), hashes=hashes, exclude=exclude, files=files is not None)
 
-            def _line(line):
+    with ProgressAggregator(tqdm(unit=" files", **tqdm_kwargs)) as bar:
+
+        def _line(line):
+            tag = line[1 if line[0] == "\\" else 0 :].partition(" ")[0]  # noqa: E203
+            if tag not in streams:
+                click.echo(line, err=True)
+                return
+            streams[tag].write(line + "\n")
+            if tag == tags[0]:
                 bar.update(1)
 
-            cmd = checksum_command(base, host, exclude_filename, hash_cmd)
-            genproc = runner(host)(
-                cmd,
+        with NamedTemporaryFile("w+b") as in_stream:
+            source = inspect.getsource(hashing).encode()
+            in_stream.write(b"%d\n" % len(source) + source)
+            in_stream.write(json.dumps(request).encode() + b"\n")
+            for name in files or ():
+                in_stream.write(os.fsencode(name) + b"\0")
+            in_stream.seek(0)
+            proc = runner(host)(
+                f"{python} -c {shlex.quote(AGENT_BOOTSTRAP)}",
                 warn=True,
                 watchers=[LineWatcher(line_callback=_line)],
-                hide=True,
-                in_stream=False,
-                out_stream=tempfile.file,
+                in_stream=in_stream,
+                cancel=cancel,
             )
 
-            if genproc.failed:
-                raise ChecksumGenerationFailed(genproc.stderr)
+    _check_cancel(cancel)
+    if proc.failed:
+        raise ChecksumGenerationFailed(proc.stderr)
+
+
+def _check_cancel(cancel):
+    """raise ChecksumGenerationFailed if the cancel event is set"""
+    if cancel is not None and cancel.is_set():
+        raise ChecksumGenerationFailed("checksum generation cancelled")
 
-        tempfile.close()
 
-        if exclude_filename:
-            delete_exclude_file(host, exclude_filename)
+def needs_agent(hashes):
+    """return True if any of hashes is only computed on remote targets by the python agent"""
+    return any(is_tree_hash(hash) or is_sampled_hash(hash) for hash in hashes)
 
-        # sort checksums into output file
-        with output_file.open("w") as ofp:
-            run(f"{which('sort')} {tempfile.name}", in_stream=False, out_stream=ofp, hide=True)
 
-    return output_file
+def check_remote_hashes(host, hashes):
+    """raise ChecksumGenerationFailed if hashes need the python agent and host has no python3"""
+    if needs_agent(hashes) and not which("python3", host, quiet=True):
+        names = ", ".join(hash for hash in hashes if needs_agent([hash]))
+        raise ChecksumGenerationFailed(f"{names} on remote targets requires python3, not available on {host}")
 
 
-def checksum_command(base, host, exclude_filename, hash_cmd):
-    cmd = f"cd {str(base)}; {which('find', host)} . -type f"
-    if exclude_filename:
-        cmd += f" | {which('egrep', host)} -v -f {exclude_filename} | xargs -n 1 -I FILE {hash_cmd} 'FILE'"
+def remote_commands(hashes, agent=False):
+    """return every command a remote checksum of hashes may look up, so they can be resolved in one probe"""
+    commands = ["python3"] if agent or needs_agent(hashes) else []
+    commands.append("find")
+    for hash in hashes:
+        if hash == STAT_HASH:
+            commands.append("stat")
+        elif is_flat_hash(hash):
+            commands.extend([hash + "sum", hash])
+    return commands
+
+
+def hash_command(hash, host):
+    """return host command printing BSD-style digest lines for its file arguments"""
+
+    # try linux command without breaking
+    hash_cmd = which(hash + "sum", host, quiet=True)
+    if hash_cmd:
+        # add option if linux
+        hash_cmd += " --tag"
     else:
-        cmd += f" -exec {hash_cmd} \\{{\\}} \\;"
-    return cmd
-
-
-def generate_exclude_file(host, rsync_args):
-    patterns = rsync_exclude_patterns(rsync_args)
-    if not patterns:
-        return ""
-    with NamedTemporaryFile("w+", delete=False) as tempfile:
-        tempfile.file.write("\n".join(patterns) + "\n")
-        tempfile.close()
-        cmd = "TEMPFILE=$(mktemp) && cat ->$TEMPFILE && echo $TEMPFILE"
-        with Path(tempfile.name).open("r") as ifp:
-            proc = runner(host)(cmd, in_stream=ifp, warn=True, hide=True)
+        # try bsd-style hash command
+        hash_cmd = which(hash, host)
+    return hash_cmd
+
+
+def stat_command(host):
+    """return host command printing a 'size-mtime name' record for each of its file arguments, and the record separator
+
+    GNU stat ends each record with a NUL, so every filename is delimited; BSD stat can only end it with a newline.
+    """
+    stat_cmd = which("stat", host)
+    probe = runner(host)(f"{stat_cmd} --version", warn=True)
+    if probe.ok:
+        # GNU coreutils
+        return f'{stat_cmd} --printf "%s-%Y %n\\0"', b"\0"
+    return f'{stat_cmd} -f "%z-%m %N"', b"\n"
+
+
+def checksum_command(base, host, hash_cmd, list_filename=""):
+    """return shell command writing BSD-style checksum lines for files below base
+
+    If list_filename is given, it names a remote file of NUL-delimited names to hash instead of finding all files.
+    The command fails if either hashing or collecting the batch output fails.
+    """
+    find = which("find", host)
+    cmd = f"cat {list_filename}" if list_filename else f"{find} . -type f -print0"
+
+    # each parallel batch writes its own file so output lines from concurrent hash processes never interleave
+    batch_cmd = f"{hash_cmd} \"$@\" >\"$(mktemp \"$0/XXXXXXXX\")\""
+    cmd += f" | xargs -0 -r -P {HASH_JOBS} -n {HASH_BATCH_SIZE} sh -c '{batch_cmd}' \"$OUTDIR\""
+    # the batch files are collected by find, as a glob of them can exceed ARG_MAX
+    return (
+        f"cd {str(base)} || exit 1; OUTDIR=$(mktemp -d) || exit 1; {cmd}; RC=$?; "
+        f'{find} "$OUTDIR" -type f -exec cat {{}} +; CAT_RC=$?; rm -rf "$OUTDIR"; '
+        "[ $RC -ne 0 ] || RC=$CAT_RC; exit $RC"
+    )
+
+
+class StatWriter:
+    """binary out_stream writing a BSD-style STAT line to another stream for each stat_command() record"""
+
+    def __init__(self, out_stream, separator, record_callback):
+        self.out_stream = out_stream
+        self.separator = separator
+        self.record_callback = record_callback
+        self.partial = b""
+
+    def write(self, data):
+        records = (self.partial + data).split(self.separator)
+        self.partial = records.pop()
+        for record in records:
+            if record:
+                digest, _, name = os.fsdecode(record).partition(" ")
+                self.out_stream.write(tag_line(hash_tag(STAT_HASH), name, digest) + "\n")
+                self.record_callback()
+
+
+class NameFilter:
+    """binary out_stream writing the NUL-delimited names not excluded by a PathFilter to another stream"""
+
+    def __init__(self, out_stream, exclude):
+        self.out_stream = out_stream
+        self.exclude = exclude
+        self.partial = b""
+
+    def write(self, data):
+        names = (self.partial + data).split(b"\0")
+        self.partial = names.pop()
+        kept = [name + b"\0" for name in names if name and not self.exclude.excludes_path(os.fsdecode(name))]
+        if kept:
+            self.out_stream.write(b"".join(kept))
+
+
+def filtered_list_file(base, host, exclude):
+    """write the regular files below base on host not excluded by a PathFilter into a remote temp file, returning its name
+
+    The remote find output is filtered as it arrives and piped straight back
+    to the host, so the file list is never held in memory.
+    """
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, "rb") as in_stream:
+        upload = start(LIST_FILE_COMMAND, host, in_stream=in_stream, warn=True)
+        with open(write_fd, "wb") as out_stream:
+            listing = runner(host)(
+                f"cd {str(base)} && {which('find', host)} . -type f -print0",
+                warn=True,
+                out_stream=NameFilter(out_stream, exclude),
+            )
+        proc = upload.join()
+    if listing.failed:
+        raise ChecksumGenerationFailed(listing.stderr)
+    if proc.failed:
+        raise ChecksumGenerationFailed(proc.stderr)
+    return proc.stdout.strip()
+
+
+def generate_list_file(host, files):
+    """stream NUL-delimited file names into a remote temp file, returning its name"""
+    with NamedTemporaryFile("w+b") as tempfile:
+        for name in files:
+            tempfile.write(os.fsencode(name) + b"\0")
+        tempfile.seek(0)
+        proc = runner(host)(LIST_FILE_COMMAND, in_stream=tempfile, warn=True)
         if proc.failed:
-            raise ChecksumExcludeFileGenerationFailed(proc.stderr)
+            raise ChecksumGenerationFailed(proc.stderr)
         return proc.stdout.strip()
 
 
-def delete_exclude_file(host, filename):
-    runner(host)(f"rm {filename}", hide=True)
+def delete_remote_file(host, filename):
+    runner(host)(f"rm {filename}")
 
 
 def delete_file(filename):
@@ -126,15 +402,81 @@ def delete_file(filename):
 
 
 def compare_checksums(src_sums, dst_sums):
-    """run diff on hash digest files, return length if identical, otherwise raise exception"""
+    """compare hash digest files, return matched count if identical, otherwise raise exception"""
 
-    diff = run(f"{which('diff')} {str(src_sums)} {str(dst_sums)}", in_stream=False, hide=True, warn=True)
-    if diff.failed:
-        output_dir = Path(src_sums).parent
-        (output_dir / "cptree.diff.out").write_text(diff.stdout)
-        (output_dir / "cptree.diff.err").write_text(diff.stderr)
+    output_dir = Path(src_sums).parent
+    report_file = output_dir / f"cptree.compare{Path(src_sums).suffix}.jsonl"
+    counts = compare_digests(src_sums, dst_sums, report_file)
+    if counts["missing"] or counts["extra"] or counts["mismatched"]:
         tempdir = mkdtemp(prefix="cptree")
-        shutil.copytree(output_dir, tempdir.name, dirs_exist_ok=True)
-        raise ChecksumCompareFailed(f"details written to {tempdir}")
-    wc = run(f"{which('wc')} -l {str(src_sums)}", in_stream=False, hide=True)
-    return int(wc.stdout.split()[0])
+        shutil.copytree(output_dir, tempdir, dirs_exist_ok=True)
+        summary = ", ".join(f"{k}={v}" for k, v in counts.items())
+        raise ChecksumCompareFailed(f"{summary}; details written to {tempdir}")
+    return counts["matched"]
+
+
+def compare_digests(src_sums, dst_sums, report_file):
+    """merge-compare two sorted digest files, writing differences as JSON lines and returning counts"""
+
+    counts = dict(matched=0, missing=0, extra=0, mismatched=0)
+    src_records = _digest_records(src_sums)
+    dst_records = _digest_records(dst_sums)
+    src = next(src_records, None)
+    dst = next(dst_records, None)
+
+    if src is not None and dst is not None and _digest_tag(src[0]) != _digest_tag(dst[0]):
+        raise ChecksumCompareFailed(f"checksum formats differ: {_digest_tag(src[0])} != {_digest_tag(dst[0])}")
+
+    with Path(report_file).open("w") as ofp:
+
+        def _report(status, key, **digests):
+            ofp.write(json.dumps(dict(status=status, path=_digest_path(key), **digests)) + "\n")
+
+        while src is not None or dst is not None:
+            if dst is None or (src is not None and src[0] < dst[0]):
+                counts["missing"] += 1
+                _report("missing", src[0], src=src[1])
+                src = next(src_records, None)
+            elif src is None or dst[0] < src[0]:
+                counts["extra"] += 1
+                _report("extra", dst[0], dst=dst[1])
+                dst = next(dst_records, None)
+            else:
+                if src[1] == dst[1]:
+                    counts["matched"] += 1
+                else:
+                    counts["mismatched"] += 1
+                    _report("mismatched", src[0], src=src[1], dst=dst[1])
+                src = next(src_records, None)
+                dst = next(dst_records, None)
+
+    return counts
+
+
+def _digest_records(filename):
+    """yield (key, digest) for each line of a sorted BSD-style digest file
+
+    The key is the raw line up to and including ') = ', so keys compare in the
+    same byte order as the lines themselves.
+    """
+    with Path(filename).open("rb") as ifp:
+        for line in ifp:
+            line = line.rstrip(b"\n")
+            if line:
+                key, sep, digest = line.rpartition(b") = ")
+                if not sep:
+                    raise ChecksumCompareFailed(f"unrecognized checksum line in {filename}: {line!r}")
+                yield key + sep, digest.decode()
+
+
+def _digest_tag(key):
+    """return the hash tag from a digest record key"""
+    return key.lstrip(b"\\").partition(b" (")[0].decode()
+
+
+def _digest_path(key):
+    """return the unescaped filename from a digest record key"""
+    path = key.decode(errors="surrogateescape").partition(" (")[2][: -len(") = ")]
+    if key.startswith(b"\\"):
+        path = re.sub(r"\\(.)", lambda m: UNESCAPE_CHARS[m.group(1)], path)
+    return path
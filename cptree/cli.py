@@ -7,6 +7,7 @@ import click.core
 
 from .cptree import cptree
 from .exception_handler import ExceptionHandler
+from .hashing import TREE_SUFFIX
 from .shell import _shell_completion
 from .version import __timestamp__, __version__
 
@@ -22,8 +23,10 @@ def _ehandler(ctx, option, debug):
 
 
 FLAG_CHOICES = ["ask", "force", "never"]
-HASH_CHOICES = list(HASHES) + ["none"]
+HASH_CHOICES = list(HASHES) + [hash + TREE_SUFFIX for hash in HASHES] + ["none"]
 PROGRESS_CHOICES = ["enable", "ascii", "none"]
+VERIFY_LEVELS = ["stat", "sampled", "full"]
+PRESCAN_ENGINES = ["rsync", "native", "delta"]
 
 
 @click.command("cptree", context_settings={"auto_envvar_prefix": "CPTREE"})
@@ -74,8 +77,62 @@ PROGRESS_CHOICES = ["enable", "ascii", "none"]
     "-h",
     "--hash",
     type=click.Choice(HASH_CHOICES),
-    default=DEFAULT_HASH,
-    help="select checksum hash",
+    default=[DEFAULT_HASH],
+    multiple=True,
+    help="select checksum hash; repeat for several hashes computed in one pass",
+)
+@click.option(
+    "--verify-level",
+    type=click.Choice(VERIFY_LEVELS),
+    default="full",
+    help="checksum size and mtime only, sampled blocks, or full contents",
+)
+@click.option(
+    "--cache/--no-cache",
+    is_flag=True,
+    default=False,
+    help="reuse cached local checksums from a cache file next to the output directory",
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    help="verify only files changed by rsync transfer",
+)
+@click.option(
+    "--prescan",
+    "prescan_engine",
+    type=click.Choice(PRESCAN_ENGINES),
+    default="rsync",
+    help="list source items with rsync, walk a local source in parallel, or list only the delta of a dry run",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    help="start rsync transfer while prescan is still running",
+)
+@click.option(
+    "-j",
+    "--parallel",
+    type=click.IntRange(1, 64),
+    default=1,
+    help="split transfer across N concurrent rsync processes",
+)
+@click.option(
+    "--concurrent-hash",
+    is_flag=True,
+    help="checksum source while rsync transfer runs",
+)
+@click.option(
+    "--remote-agent",
+    is_flag=True,
+    help="hash remote files with a python agent sent over ssh, falling back to shell commands",
+)
+@click.option(
+    "--command-cache-ttl",
+    type=click.IntRange(0),
+    default=0,
+    help="reuse command paths found on each host for N seconds; 0 disables the on-disk cache",
 )
 @click.option(
     "-r/-R",
@@ -99,6 +156,15 @@ def cli(
     output_dir,
     file_list,
     hash,
+    verify_level,
+    cache,
+    incremental,
+    prescan_engine,
+    pipeline,
+    parallel,
+    concurrent_hash,
+    remote_agent,
+    command_cache_ttl,
     rsync,
     rsync_args,
     src,
@@ -109,8 +175,10 @@ def cli(
         create = False
     if delete == "never":
         delete = False
-    if hash == "none":
+    if "none" in hash:
         hash = None
+    else:
+        hash = list(dict.fromkeys(hash))
     if progress == "none":
         progress = None
 
@@ -130,6 +198,15 @@ def cli(
         progress=progress,
         output_dir=output_dir,
         hash=hash,
+        verify_level=verify_level,
+        cache=cache,
+        incremental=incremental,
+        prescan_engine=prescan_engine,
+        pipeline=pipeline,
+        parallel=parallel,
+        concurrent_hash=concurrent_hash,
+        command_cache_ttl=command_cache_ttl,
+        remote_agent=remote_agent,
         rsync=rsync,
         rsync_args=rsync_args,
         file_list=file_list,
@@ -1,18 +1,25 @@
 # utility functions
 
+import json
 import os
 import re
+import shlex
+import socket
+import tempfile
+import threading
+import time
+from functools import partial
 from pathlib import Path
 
-import fabric
-import invoke
-
 from .exceptions import CommandNotFound
+from .process import on_command_not_found, run
 
 OS_COMMAND_MAP = {"which": {"linux": "which", "win": "where", "openbsd": "which", "cygwin": "which"}}
 
 OS_BASE = re.compile(r"([^0-9]+)")
 
+COMMAND_CACHE_FILE = Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "cptree" / "commands.json"
+
 
 def map_cmd(command):
     platform = os.sys.platform
@@ -56,18 +63,127 @@ def write_file_lines(dir, name, lines):
 
 
 def runner(host):
-    return fabric.Connection(host).run if host else invoke.run
+    """return function running a command on host, or locally if host is None"""
+    return partial(run, host=host)
 
 
 def host_mode(host):
     return "remote" if host else "local"
 
 
+class CommandResolver:
+    """resolve command paths per host, probing all of a host's unresolved commands in one round trip
+
+    Paths are kept for the life of the process.  If ttl is set, found paths
+    are also saved to cache_file and reused for ttl seconds.  A host's
+    entries are discarded when one of its commands exits as not found or not
+    executable.
+    """
+
+    def __init__(self, cache_file=COMMAND_CACHE_FILE, ttl=0):
+        self.cache_file = Path(cache_file)
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.hosts = {}
+        self.saved = None
+
+    def configure(self, ttl=0, cache_file=None):
+        """enable the on-disk cache for ttl seconds, or disable it if ttl is 0"""
+        with self.lock:
+            self.ttl = ttl
+            if cache_file is not None:
+                self.cache_file = Path(cache_file)
+            self.saved = None
+
+    def _key(self, host):
+        return host or f"local:{socket.gethostname()}"
+
+    def _load(self):
+        if self.saved is None:
+            try:
+                self.saved = json.loads(self.cache_file.read_text())
+            except (OSError, ValueError):
+                self.saved = {}
+        return self.saved
+
+    def _save(self):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=self.cache_file.parent, delete=False) as ofp:
+            json.dump(self.saved, ofp)
+        os.replace(ofp.name, self.cache_file)
+
+    def probe_script(self, commands):
+        """return a shell loop printing a 'command NAME PATH' line for each command, with PATH empty if not found"""
+        names = " ".join(shlex.quote(command) for command in commands)
+        return f'for cmd in {names}; do echo "command $cmd $({map_cmd("which")} "$cmd" 2>/dev/null | head -n 1)"; done'
+
+    def parse_probe(self, commands, lines):
+        """return a dict of command paths, or None, from the output lines of probe_script"""
+        found = dict.fromkeys(commands)
+        for line in lines:
+            kind, _, line = line.partition(" ")
+            command, _, path = line.partition(" ")
+            if kind == "command" and command in found and path.strip():
+                found[command] = path.strip()
+        return found
+
+    def _resolved(self, host):
+        resolved = self.hosts.setdefault(host, {})
+        if self.ttl:
+            entry = self._load().get(self._key(host))
+            if entry and time.time() - entry["time"] < self.ttl:
+                for command, path in entry["commands"].items():
+                    resolved.setdefault(command, path)
+            else:
+                self.saved.pop(self._key(host), None)
+        return resolved
+
+    def unresolved(self, commands, host=None):
+        """return the commands whose paths on host are not yet known"""
+        with self.lock:
+            resolved = self._resolved(host)
+            return [command for command in dict.fromkeys(commands) if command not in resolved]
+
+    def remember(self, host, found):
+        """keep a dict of command paths, or None for missing commands, found on host by a probe"""
+        with self.lock:
+            self._resolved(host).update(found)
+            if self.ttl and any(found.values()):
+                entry = self.saved.setdefault(self._key(host), {"time": time.time(), "commands": {}})
+                entry["commands"].update({command: path for command, path in found.items() if path})
+                self._save()
+
+    def resolve(self, commands, host=None):
+        """return a dict of command paths on host, with None for commands that are not available"""
+        with self.lock:
+            missing = self.unresolved(commands, host)
+            if missing:
+                result = run(self.probe_script(missing), host=host, warn=True)
+                self.remember(host, self.parse_probe(missing, result.stdout.splitlines()))
+            resolved = self.hosts[host]
+            return {command: resolved[command] for command in commands}
+
+    def invalidate(self, host=None):
+        """forget the command paths of host, in memory and on disk"""
+        with self.lock:
+            self.hosts.pop(host, None)
+            if self.ttl and self._load().pop(self._key(host), None) is not None:
+                self._save()
+
+
+resolver = CommandResolver()
+on_command_not_found(resolver.invalidate)
+
+
+def resolve_commands(commands, host=None):
+    """resolve several local or remote commands in a single probe, returning a dict of paths or None"""
+    return resolver.resolve(commands, host)
+
+
 def which(command, host=None, quiet=False):
     """return local or remote command path if valid, otherwise raise exception or optionally return None"""
-    probe = runner(host)(f"{map_cmd('which')} {command}", in_stream=False, hide=True, warn=True)
-    cmd = probe.stdout.strip()
-    if probe.ok and cmd:
+    cmd = resolver.resolve([command], host)[command]
+    if cmd:
         return cmd
     elif quiet:
         return None
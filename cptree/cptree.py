@@ -1,24 +1,36 @@
 # cptree implementation
 
+import os
+import queue
 import re
 import shlex
 import shutil
+import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 
 import click
-from invoke import run
 from tqdm import tqdm
 
-from .checksum import checksum, compare_checksums
-from .common import parse_int, which, write_file_lines
+from .cache import ChecksumCache, cache_file
+from .checksum import check_remote_hashes, checksums, compare_checksums, remote_commands
+from .common import parse_int, resolver, split_target, which
 from .exceptions import (
     RsyncTransferFailed,
     UnrecognizedRsyncPrescanOutput,
     UnsupportedRsyncArgument,
 )
-from .verify import verify_dst_directory, verify_output_directory, verify_src_directory
+from .exclude import exclude_filter
+from .hashing import SAMPLED_SUFFIX, STAT_HASH, base_hash, hash_tag
+from .inventory import Inventory
+from .process import connections, run, start
+from .progress import ProgressAggregator
+from .verify import verify_directories
+from .walker import walk_tree
 from .watcher import LineWatcher
 
 FILE_PATTERN = re.compile(r"^(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s(.*)$")
@@ -29,10 +41,25 @@ FILE_TYPE = {
     "p": "pipes",
     "c": "devices",
     "b": "devices",
+    "s": "sockets",
 }
 
 NAME_LENGTH = 12
 
+# blocks of listing lines read ahead of the prescan
+LINE_QUEUE_DEPTH = 16
+
+# itemized changes, length and transfer-relative name of each file rsync touches
+OUT_FORMAT = "'~%i %l %n'"
+DELTA_PATTERN = re.compile(r"^~(\S+)\s+([0-9,]+)\s(.*)$")
+
+# itemized file type codes as --list-only type characters
+DELTA_TYPE = {"f": "-", "d": "d", "L": "l", "D": "c", "S": "p"}
+
+# ssh command sharing one multiplexed connection per host across every rsync of a run
+RSYNC_SSH = "ssh -o ControlMaster=auto -o ControlPath={} -o ControlPersist=60"
+SSH_CONTROL_NAME = "%C"
+
 RESERVED_RSYNC_ARGS = [
     "-P",
     "--progress",
@@ -48,8 +75,6 @@ RESERVED_RSYNC_ARGS = [
     "-f",
     "-F",
     "--filter",
-    "--include",
-    "--include-from",
     "--files-from",
     "-C",
     "--cvs-exclude",
@@ -69,29 +94,13 @@ def mkopts(kwargs):
     return opts
 
 
-def count_items(items):
-    size = 0
-    files = []
-    counts = {
-        "d": 0,
-        "-": 0,
-        "l": 0,
-        "p": 0,
-        "c": 0,
-        "b": 0,
-    }
-    for item in items:
-        match = FILE_PATTERN.match(item)
-        if not match:
-            raise UnrecognizedRsyncPrescanOutput(item)
-        fields = match.groups()
-        file_length = parse_int(fields[1])
-        size += int(file_length)
-        file_type = item[0]
-        counts[file_type] += 1
-        if file_type == "-":
-            files.append(fields[4])
-    return size, files, counts
+def parse_item(item):
+    """return (type, length, name) of an rsync --list-only line"""
+    match = FILE_PATTERN.match(item)
+    if not match:
+        raise UnrecognizedRsyncPrescanOutput(item)
+    fields = match.groups()
+    return item[0], parse_int(fields[1]), fields[4]
 
 
 def summarize_item_details(counts):
@@ -102,32 +111,153 @@ def summarize_item_details(counts):
     return details
 
 
-def prescan(src, dst, cmd, opts, file_list):
-    if not file_list:
+class _LineBlocks:
+    """watcher passing each block of output lines to a bounded queue"""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def feed_lines(self, lines):
+        self.blocks.put(lines)
+
+
+def _rsync_lines(command):
+    """yield non-empty output lines of an rsync command, exiting with rsync's status on failure
+
+    The command is run by the streaming process runner.  Its output blocks
+    wait in a bounded queue until they are consumed, and closing the
+    generator early kills the command.
+    """
+    blocks = queue.Queue(maxsize=LINE_QUEUE_DEPTH)
+    cancel = threading.Event()
+    proc = start(command, watchers=[_LineBlocks(blocks)], warn=True, cancel=cancel)
+    results = []
+
+    def _join():
+        results.append(proc.join())
+        blocks.put(None)
+
+    threading.Thread(target=_join, daemon=True).start()
+    block = ()
+    try:
+        while block is not None:
+            for line in block:
+                if line:
+                    yield line
+            block = blocks.get()
+    finally:
+        if block is not None:
+            cancel.set()
+            while block is not None:
+                block = blocks.get()
+    result = results[0]
+    if result.failed:
+        click.echo(result.stderr, err=True)
+        sys.exit(result.return_code)
+
+
+def rsync_listing(src, dst, cmd, opts):
+    """yield (type, size, name) of each item rsync --list-only reports"""
+    for item in _rsync_lines(f"{cmd} -a --list-only {opts} {src} {dst}"):
+        file_type, length, name = parse_item(item)
+        if file_type == "l":
+            name = name.partition(" -> ")[0]
+        yield file_type, length, _rsync_unescape(name)
+
+
+def parse_delta_item(line):
+    """return (type, size, name) of an itemized dry run line, or None for lines naming no transfer"""
+    match = DELTA_PATTERN.match(line)
+    if not match:
+        return None
+    codes, length, name = match.groups()
+    # '*deleting' and other '*' messages name items removed from dst, not transferred
+    if codes.startswith("*"):
+        return None
+    file_type = DELTA_TYPE.get(codes[1], "-")
+    # content is only sent for updated, created or hard-linked items
+    size = parse_int(length) if codes[0] in "<>ch" else 0
+    if file_type == "d":
+        name = name.rstrip("/") or "."
+    elif file_type == "l":
+        name = name.partition(" -> ")[0]
+    return file_type, size, name
+
+
+def rsync_delta_listing(src, dst, cmd, opts):
+    """yield (type, size, name) of each item an rsync dry run against dst would transfer or update"""
+    for line in _rsync_lines(f"{cmd} -a --dry-run --out-format {OUT_FORMAT} {opts} {src} {dst}"):
+        item = parse_delta_item(line)
+        if item is not None:
+            file_type, length, name = item
+            yield file_type, length, _rsync_unescape(name)
+
+
+def prescan_records(src, dst, cmd, opts, engine):
+    """return a generator of (type, size, name) records from the selected prescan engine"""
+    host, base = split_target(src)
+    if engine == "native" and host:
+        click.echo("WARNING: native prescan requires a local source; using rsync", err=True)
+        engine = "rsync"
+    if engine == "native":
+        return walk_tree(base, exclude_filter(opts))
+    if engine == "delta":
+        return rsync_delta_listing(src, dst, cmd, opts)
+    return rsync_listing(src, dst, cmd, opts)
+
+
+def prescan(src, dst, cmd, opts, file_list, engine="rsync", inventory=None, item_callback=None, cancel=None):
+    """stream the list of items to transfer into a compact inventory
+
+    The rsync engine lists items with rsync --list-only; the native engine
+    walks a local source in parallel, applying the exclude options only.
+    Sizes and counts are aggregated as items arrive.  In file_list mode each
+    name is echoed and only counted, not stored.
+
+    When item_callback is given the scan is running alongside the transfer:
+    it is called with the type and size of each item, devices produce a
+    warning instead of a prompt, and the summary is written above the
+    progress bar once the scan completes.  Setting the cancel event stops
+    the scan early.
+    """
+    pipelined = item_callback is not None
+    if not (file_list or pipelined):
         click.echo("Scanning...\r", nl=False)
-    scanproc = run(f"{cmd} -a --list-only {opts} {src} {dst}", in_stream=False, hide=True, warn=True)
-    if scanproc.ok:
-        items = scanproc.stdout.strip().split("\n")
-    else:
-        click.echo(scanproc.stderr, err=True)
-        sys.exit(scanproc.return_code)
-
-    size, files, counts = count_items(items)
-
-    details = summarize_item_details(counts)
-
-    check_for_device_transfers(counts, file_list)
-
-    if not file_list:
-        click.echo(f"Transferring {len(items)} items: [{', '.join(details)}]")
-
-    return size, items, files
-
-
-def check_for_device_transfers(counts, file_list):
+    records = prescan_records(src, dst, cmd, opts, engine)
+
+    if inventory is None:
+        inventory = Inventory()
+    try:
+        for file_type, length, name in records:
+            if cancel is not None and cancel.is_set():
+                return inventory
+            if file_list:
+                inventory.tally(file_type, length)
+                click.echo(name)
+            else:
+                inventory.add(file_type, length, name)
+            if pipelined:
+                item_callback(file_type, length)
+    finally:
+        # stops the listing command if the scan ends early
+        records.close()
+
+    details = summarize_item_details(inventory.counts)
+
+    check_for_device_transfers(inventory.counts, file_list or pipelined)
+
+    if pipelined:
+        tqdm.write(f"Scanned {inventory.item_count} items: [{', '.join(details)}]")
+    elif not file_list:
+        click.echo(f"Transferring {inventory.item_count} items: [{', '.join(details)}]")
+
+    return inventory
+
+
+def check_for_device_transfers(counts, warn_only):
     if (counts["b"] + counts["c"]) > 0:
-        if file_list:
-            click.output("WARNING: Transfer includes devices.", err=True)
+        if warn_only:
+            click.echo("WARNING: Transfer includes devices.", err=True)
         else:
             click.confirm(
                 "Transfer includes devices.  Are you certain you want to proceed?",
@@ -135,32 +265,82 @@ def check_for_device_transfers(counts, file_list):
             )
 
 
-def cptree(*args, output_dir=None, **kwargs):
+def cptree(src, dst, *, output_dir=None, **kwargs):
     """call _cptree with work_dir from argument or a temp dir"""
 
-    if output_dir:
-        output_dir = Path(output_dir)
-        if not output_dir.is_dir():
-            output_dir.mkdir()
-        kwargs["output_dir"] = output_dir
-        return _cptree(*args, **kwargs)
-    else:
-        with TemporaryDirectory() as temp_dir:
-            kwargs["output_dir"] = Path(temp_dir)
-            return _cptree(*args, **kwargs)
-
-
-def _verify_dirs(src, dst, output_dir, create, delete):
-    verify_output_directory(output_dir)
-    verify_src_directory(src)
-    verify_dst_directory(dst, create, delete)
+    # stops a pipelined scan or concurrent source hash still running when the run ends
+    cancel = threading.Event()
+    try:
+        with ssh_control_dir(src, dst) as control_dir:
+            kwargs["ssh_control_dir"] = control_dir
+            kwargs["cancel"] = cancel
+            if output_dir:
+                output_dir = Path(output_dir)
+                if not output_dir.is_dir():
+                    output_dir.mkdir()
+                kwargs["output_dir"] = output_dir
+                return _cptree(src, dst, **kwargs)
+            else:
+                if kwargs.get("cache"):
+                    click.echo("WARNING: checksum cache requires --output_dir; disabled", err=True)
+                    kwargs["cache"] = False
+                with TemporaryDirectory() as temp_dir:
+                    kwargs["output_dir"] = Path(temp_dir)
+                    return _cptree(src, dst, **kwargs)
+    finally:
+        cancel.set()
+        connections.close()
+
+
+@contextmanager
+def ssh_control_dir(src, dst):
+    """yield a private directory for the ssh master sockets of a remote transfer, or None for a local one
+
+    The directory is created mode 0700 for this run only.  Afterwards, any
+    master still persisting is told to exit and the directory is removed.
+    """
+    hosts = list(dict.fromkeys(host for host, _ in [split_target(src), split_target(dst)] if host))
+    if not hosts:
+        yield None
+        return
+    control_dir = mkdtemp(prefix="cptree-ssh-")
+    try:
+        yield control_dir
+    finally:
+        control_path = str(Path(control_dir) / SSH_CONTROL_NAME)
+        for host in hosts:
+            try:
+                subprocess.run(
+                    ["ssh", "-o", f"ControlPath={control_path}", "-O", "exit", host],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            except OSError:
+                pass
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+
+def _verify_dirs(src, dst, output_dir, create, delete, hashes=None, agent=False):
+    """verify directories, resolving the local transfer commands and remote checksum commands in the same preflight"""
+    commands = {None: ["rsync", "sort"]}
+    for target in [src, dst]:
+        host, _ = split_target(target)
+        if host and hashes:
+            commands.setdefault(host, []).extend(remote_commands(hashes, agent))
+    verify_directories(src, dst, output_dir, create, delete, commands)
+    # fail before the transfer rather than after it if a remote side cannot be checksummed
+    for host in commands:
+        if host:
+            check_remote_hashes(host, hashes)
 
 
 def _rsync_echo(cmd):
     """return rsync command line without our added progress formatting options"""
-    hide_options = [("--info", True), ("--out-format", True), ("--progress", False)]
+    hide_options = [("--info", True), ("--out-format", True), ("--progress", False), ("--no-human-readable", False)]
     words = shlex.split(cmd)
     for word, arg in hide_options:
+        if word not in words:
+            continue
         pos = words.index(word)
         words.pop(pos)
         if arg:
@@ -191,27 +371,50 @@ def _cptree(  # noqa: C901
     rsync=True,
     rsync_args=None,
     file_list=False,
+    cache=False,
+    incremental=False,
+    verify_level="full",
+    concurrent_hash=False,
+    prescan_engine="rsync",
+    pipeline=False,
+    parallel=1,
+    command_cache_ttl=0,
+    remote_agent=False,
+    ssh_control_dir=None,
+    cancel=None,
 ):
-    _verify_dirs(src, dst, output_dir, create, delete)
+    resolver.configure(command_cache_ttl)
+    if isinstance(hash, str):
+        hash = [hash]
+    if hash:
+        hash = _level_hashes(hash, verify_level)
+    _verify_dirs(src, dst, output_dir, create, delete, hash, remote_agent)
 
     rsync_cmd = which("rsync")
-    rsync_args = _check_rsync_args(rsync_args)
-
-    total_bytes, items, files = prescan(src, dst, rsync_cmd, rsync_args, file_list)
-    total_items = len(items)
+    rsync_args = _multiplex_rsync_args(_check_rsync_args(rsync_args), ssh_control_dir)
+
+    if parallel > 1:
+        _check_parallel_rsync_args(rsync_args)
+        if pipeline:
+            click.echo("WARNING: --parallel shards the complete prescan; disabling --pipeline", err=True)
+            pipeline = False
+
+    if pipeline and prescan_engine == "delta":
+        click.echo("WARNING: a delta prescan lists what the transfer changes; disabling --pipeline", err=True)
+        pipeline = False
+
+    # a pipelined prescan fills the inventory while rsync runs
+    pipeline = pipeline and not file_list
+    if pipeline:
+        inventory = Inventory()
+    else:
+        inventory = prescan(src, dst, rsync_cmd, rsync_args, file_list, prescan_engine)
 
     if file_list:
-        pattern = re.compile(r"\S+\s+\S+\s+\S+\s+\S+\s+(\S+)")
-        for item in items:
-            match = pattern.match(item)
-            filename = match.groups()[0]
-            click.echo(filename)
         return 0
 
-    file_list = write_file_lines(output_dir, "cptree.files", ["./" + f for f in files])
-
     tqdm_kwargs = dict(
-        total=total_bytes,
+        total=inventory.total_size,
         disable=bool(progress in ["disable", False, None]),
         ascii=bool(progress == "ascii"),
         ncols=shutil.get_terminal_size().columns - 1,
@@ -219,64 +422,257 @@ def _cptree(  # noqa: C901
         delay=1,
     )
 
-    bar = tqdm(unit="B", unit_scale=True, **tqdm_kwargs)
+    def _describe(items):
+        total_items = inventory.item_count
+        return f"[{str(items).zfill(len(str(total_items)))}/{total_items}]"
+
+    bar = ProgressAggregator(tqdm(unit="B", unit_scale=True, **tqdm_kwargs), describe=_describe)
+
+    scan = None
+    if cancel is None:
+        cancel = threading.Event()
+    if pipeline:
+        click.echo("Scanning during transfer")
+
+        def _item(file_type, length):
+            bar.add_total(length)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        scan_args = (src, dst, rsync_cmd, rsync_args, False, prescan_engine, inventory, _item, cancel)
+        scan = executor.submit(prescan, *scan_args)
+        executor.shutdown(wait=False)
+    else:
+        inventory.write_files(Path(output_dir) / "cptree.files")
+
+    # files whose content rsync transferred, when verifying incrementally
+    changed = [] if (incremental and rsync) else None
 
     def _line(line):
         click.echo(line)
 
+    # watcher callbacks run in each rsync process's output thread
     def _file(filename, item_count, length, codes):
-        count = str(item_count).zfill(len(str(total_items)))
-        bar.set_description(f"[{count}/{total_items}]", refresh=False)
+        if changed is not None and _content_changed(codes):
+            changed.append("./" + _rsync_unescape(filename))
+        if progress:
+            bar.update(items=1)
+        else:
+            click.echo(filename)
 
     def _progress(bytes_read, percent):
         bar.update(bytes_read)
 
     if progress:
-        progress_args = "--progress --info PROGRESS2 --out-format '~%i %l %f'"
-        watcher = LineWatcher(file_callback=_file, progress_callback=_progress)
+        progress_args = f"--progress --info PROGRESS2 --no-human-readable --out-format {OUT_FORMAT}"
+        watcher_kwargs = dict(file_callback=_file, progress_callback=_progress)
+    elif changed is not None:
+        progress_args = f"--out-format {OUT_FORMAT}"
+        watcher_kwargs = dict(file_callback=_file, line_callback=_line)
     else:
         progress_args = ""
-        watcher = LineWatcher(line_callback=_line)
+        watcher_kwargs = dict(line_callback=_line)
+
+    # hash the source while rsync is reading it, unless the file set depends on the transfer
+    src_future = None
+    if hash and concurrent_hash and rsync and changed is None:
+        click.echo("Generating source checksums during transfer")
+
+        def _hash_source():
+            if scan is not None:
+                scan.result()
+            src_kwargs = dict(tqdm_kwargs, disable=True)
+            return _checksums(
+                src,
+                hash,
+                "src",
+                output_dir,
+                src_kwargs,
+                rsync_args,
+                cache,
+                inventory,
+                quiet=True,
+                agent=remote_agent,
+                cancel=cancel,
+            )
 
-    if rsync:
+        executor = ThreadPoolExecutor(max_workers=1)
+        src_future = executor.submit(_hash_source)
+        executor.shutdown(wait=False)
 
-        cmd = f"{rsync_cmd} -avz {rsync_args} {progress_args} {src} {dst}"
-        _rsync_echo(cmd)
+    try:
+        if rsync and parallel > 1:
+            return_code, rsync_stderr = _parallel_rsync(
+                src, dst, rsync_cmd, rsync_args, progress_args, watcher_kwargs, inventory, output_dir, parallel
+            )
+        elif rsync:
 
-        proc = run(
-            cmd,
-            watchers=[watcher],
-            in_stream=False,
-            hide=True,
-            warn=True,
-        )
-        rsync_stderr = proc.stderr.strip().split("\n")
-    else:
-        click.echo("Skipping rsync transfer")
-        rsync_stderr = []
-        proc = None
+            cmd = f"{rsync_cmd} -avz {rsync_args} {progress_args} {src} {dst}"
+            _rsync_echo(cmd)
 
-    bar.close()
+            proc = run(cmd, watchers=[LineWatcher(**watcher_kwargs)], warn=True)
+            return_code = proc.return_code
+            rsync_stderr = proc.stderr.strip().split("\n")
+        else:
+            click.echo("Skipping rsync transfer")
+            rsync_stderr = []
+            return_code = None
+
+        if scan is not None:
+            scan.result()
+            inventory.write_files(Path(output_dir) / "cptree.files")
+    finally:
+        bar.close()
 
     for error in rsync_stderr:
         if error.strip():
             click.echo(error, err=True)
 
-    if proc is not None and proc.failed:
-        raise RsyncTransferFailed(f"rsync failed with error code: {proc.return_code}")
+    if return_code:
+        raise RsyncTransferFailed(f"rsync failed with error code: {return_code}")
 
-    tqdm_kwargs["total"] = len(files)
+    total_files = inventory.counts["-"]
+    tqdm_kwargs["total"] = total_files if changed is None else len(changed)
     if hash:
-        _verify_hashes(src, dst, hash, output_dir, tqdm_kwargs, rsync_args)
+        # verify exactly the files rsync listed for transfer, with its excludes already applied
+        if changed is None:
+            files, label = inventory, "transferred files" if prescan_engine == "delta" else "files"
+        else:
+            files, label = changed, "changed files"
+        _verify_hashes(
+            src, dst, hash, output_dir, tqdm_kwargs, rsync_args, cache, files, src_future, label, remote_agent
+        )
+        if changed is not None and total_files > len(changed):
+            # the files rsync skipped get the stat tier, so a damaged destination file is still caught
+            tqdm_kwargs["total"] = total_files - len(changed)
+            unchanged = UnchangedFiles(inventory, changed)
+            _verify_hashes(
+                src,
+                dst,
+                [STAT_HASH],
+                output_dir,
+                tqdm_kwargs,
+                rsync_args,
+                files=unchanged,
+                label="unchanged files",
+                agent=remote_agent,
+            )
 
-    if proc is None:
-        return 0
-    else:
-        return proc.return_code
+    return return_code or 0
+
+
+class UnchangedFiles:
+    """the regular files of an inventory that rsync did not transfer, iterated afresh for each side"""
+
+    def __init__(self, inventory, changed):
+        self.inventory = inventory
+        self.changed = changed
+
+    def __iter__(self):
+        changed = set(self.changed)
+        return (name for name in self.inventory.files() if name not in changed)
+
+
+def _multiplex_rsync_args(args, control_dir):
+    """return rsync args with an ssh command sharing one connection per host through sockets in control_dir"""
+    if control_dir is None or "RSYNC_RSH" in os.environ:
+        return args
+    words = shlex.split(args)
+    if any(word in ["-e", "--rsh"] or word.startswith("--rsh=") for word in words):
+        return args
+    return shlex.join(["-e", RSYNC_SSH.format(Path(control_dir) / SSH_CONTROL_NAME)] + words)
+
+
+def _check_parallel_rsync_args(args):
+    """ensure user rsync args work with the --files-from lists of a sharded transfer"""
+    for arg in shlex.split(args):
+        if arg.startswith("--delete"):
+            raise UnsupportedRsyncArgument(f"{repr(arg)} not supported with --parallel")
+
+
+def _parallel_rsync(src, dst, cmd, rsync_args, progress_args, watcher_kwargs, inventory, output_dir, count):
+    """run one rsync per size-balanced shard of the inventory, returning (first failing exit code, stderr lines)"""
+    shards = inventory.shard(count)
+    procs = []
+    for shard in range(count):
+        shard_file = Path(output_dir) / f"cptree.shard.{shard}"
+        inventory.write_shard(shard_file, shards, shard)
+        shard_cmd = f"{cmd} -avz {rsync_args} {progress_args} --from0 --files-from {shard_file} {src} {dst}"
+        _rsync_echo(shard_cmd)
+        procs.append(start(shard_cmd, watchers=[LineWatcher(**watcher_kwargs)], warn=True))
+    return_code = 0
+    stderr = []
+    for proc in procs:
+        result = proc.join()
+        return_code = return_code or result.return_code
+        stderr.extend(result.stderr.strip().split("\n"))
+    return return_code, stderr
+
+
+def _checksums(
+    target,
+    hashes,
+    side,
+    output_dir,
+    tqdm_kwargs,
+    rsync_args,
+    cache=False,
+    files=None,
+    quiet=False,
+    agent=False,
+    cancel=None,
+):
+    """generate checksum files for the source or destination side, using a checksum cache of this thread's own"""
+    output_files = [output_dir / f"cptree.{side}.{hash}" for hash in hashes]
+    if isinstance(files, Inventory):
+        files = files.files()
+    kwargs = dict(src=(side == "src"), dst=(side == "dst"), files=files, quiet=quiet, agent=agent, cancel=cancel)
+    with ChecksumCache(cache_file(output_dir)) if cache else nullcontext() as checksum_cache:
+        return checksums(target, hashes, output_files, tqdm_kwargs, rsync_args, cache=checksum_cache, **kwargs)
 
 
-def _verify_hashes(src, dst, hash, output_dir, tqdm_kwargs, rsync_args):
-    src_sums = checksum(src, hash, output_dir / f"cptree.src.{hash}", tqdm_kwargs, rsync_args, src=True)
-    dst_sums = checksum(dst, hash, output_dir / f"cptree.dst.{hash}", tqdm_kwargs, rsync_args, dst=True)
-    count = compare_checksums(src_sums, dst_sums)
-    click.echo(f"\nSuccessful Transfer. Verified matching {hash.upper()} hashes on {count} files.\n")
+def _verify_hashes(
+    src,
+    dst,
+    hashes,
+    output_dir,
+    tqdm_kwargs,
+    rsync_args,
+    cache=False,
+    files=None,
+    src_future=None,
+    label="files",
+    agent=False,
+):
+    """checksum both sides over the same file set and compare them, raising an exception on any difference"""
+    if src_future is None:
+        src_sums = _checksums(src, hashes, "src", output_dir, tqdm_kwargs, rsync_args, cache, files, agent=agent)
+    dst_sums = _checksums(dst, hashes, "dst", output_dir, tqdm_kwargs, rsync_args, cache, files, agent=agent)
+    if src_future is not None:
+        src_sums = src_future.result()
+    for src_file, dst_file in zip(src_sums, dst_sums):
+        count = compare_checksums(src_file, dst_file)
+    names = ", ".join(hash_tag(hash) for hash in hashes)
+    click.echo(f"\nSuccessful Transfer. Verified matching {names} checksums on {count} {label}.\n")
+
+
+def _level_hashes(hashes, verify_level):
+    """return the hashes computed for a verification level"""
+    if verify_level == "stat":
+        return [STAT_HASH]
+    if verify_level == "sampled":
+        return list(dict.fromkeys(base_hash(hash) + SAMPLED_SUFFIX for hash in hashes))
+    return hashes
+
+
+def _content_changed(codes):
+    """return True if rsync itemize codes describe a regular file whose content was transferred"""
+    return len(codes) > 1 and codes[1] == "f" and codes[0] in "<>ch"
+
+
+def _rsync_unescape(name):
+    """decode rsync's \\#ooo octal escapes of unprintable filename bytes"""
+    if "\\#" not in name:
+        return name
+    raw = name.encode(errors="surrogateescape")
+    raw = re.sub(rb"\\#([0-7]{3})", lambda match: bytes([int(match.group(1), 8)]), raw)
+    return raw.decode(errors="surrogateescape")
@@ -25,6 +25,10 @@ class CommandNotFound(Fail):
     pass
 
 
+class CommandFailed(Fail):
+    pass
+
+
 class UnsupportedRsyncArgument(Fail):
     pass
 
@@ -35,3 +39,7 @@ class UnrecognizedRsyncPrescanOutput(Fail):
 
 class ChecksumExcludeFileGenerationFailed(Fail):
     pass
+
+
+class PreflightFailed(Fail):
+    pass
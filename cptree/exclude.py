@@ -1,49 +1,113 @@
-# exclusion list functions
+# rsync include and exclude rules
 
+import re
 import shlex
-from pathlib import Path
 
 from .common import read_file_lines
+from .hashing import PathFilter
 
+FILTER_OPTIONS = {"--exclude": "-", "--include": "+"}
+FILTER_FILE_OPTIONS = {"--exclude-from": "-", "--include-from": "+"}
 
-def rsync_exclude_patterns(rsync_args):
-    """parse rsync args and return list of exclude patterns as regex"""
-    if not rsync_args:
-        return []
-    globs = []
-    args = shlex.split(rsync_args)
-    while "--exclude" in args:
-        pos = args.index("--exclude")
-        args.pop(pos)
-        globs.append(args.pop(pos))
-    while "--exclude-from" in args:
-        pos = args.index("--exclude-from")
-        args.pop(pos)
-        globs.extend(read_file_lines(Path(args.pop(pos))))
-    patterns = [glob_to_egrep(pattern) for pattern in globs]
-    return patterns
-
-
-def glob_to_egrep(glob_pattern):
-    """
-    Convert a glob pattern to a regex pattern usable by egrep.
 
-    Args:
-    - glob_pattern (str): The glob pattern to convert.
+def _rule(action, pattern):
+    """return (action, pattern), applying a '+ ' or '- ' prefix of the pattern"""
+    if pattern[:2] in ["+ ", "- "]:
+        return pattern[0], pattern[2:]
+    return action, pattern
+
+
+def rsync_filter_rules(rsync_args):
+    """parse rsync args and return their ('+' or '-', pattern) include and exclude rules in order"""
+    rules = []
+    args = shlex.split(rsync_args or "")
+    while args:
+        option, equals, value = args.pop(0).partition("=")
+        if option not in FILTER_OPTIONS and option not in FILTER_FILE_OPTIONS:
+            continue
+        if not equals:
+            if not args:
+                break
+            value = args.pop(0)
+        if option in FILTER_OPTIONS:
+            rules.append(_rule(FILTER_OPTIONS[option], value))
+        else:
+            for line in read_file_lines(value):
+                if line[0] not in ";#":
+                    rules.append(_rule(FILTER_FILE_OPTIONS[option], line))
+    return rules
+
 
-    Returns:
-    - str: A regex pattern equivalent to the input glob pattern.
+def _wildcards(pattern):
+    """return regex source for rsync wildcards, where only '**' matches across '/'"""
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+        if char == "*":
+            if pattern.startswith("*", index):
+                while pattern.startswith("*", index):
+                    index += 1
+                regex.append(".*")
+            else:
+                regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            end = index + (pattern[index : index + 1] in ["!", "^"])  # noqa: E203
+            end = pattern.find("]", end + 1)
+            if end < 0:
+                regex.append(re.escape(char))
+                continue
+            members = pattern[index:end].replace("\\", "\\\\")
+            if members[0] in "!^":
+                members = "^" + members[1:]
+            regex.append(f"(?!/)[{members}]")
+            index = end + 1
+        elif char == "\\" and index < len(pattern):
+            regex.append(re.escape(pattern[index]))
+            index += 1
+        else:
+            regex.append(re.escape(char))
+    return "".join(regex)
+
+
+def glob_regex(pattern):
+    """return (regex source, directory only) matching a relative path as rsync matches a rule pattern
+
+    A leading '/' anchors the pattern at the transfer root, otherwise it
+    matches the end of the path at a '/' boundary.  A trailing '/' matches
+    only directories, and a trailing '/***' matches a directory and
+    everything below it.
     """
-    # Escape special regex characters in glob pattern, except for * and ?
-    special_chars = "\\^$+{}[]|()."
-    for char in special_chars:
-        glob_pattern = glob_pattern.replace(char, "\\" + char)
+    dir_only = pattern.endswith("/") and pattern.strip("/") != ""
+    pattern = pattern.rstrip("/")
+    anchored = pattern.startswith("/")
+    pattern = pattern.lstrip("/")
+    suffix = ""
+    if pattern.endswith("/***"):
+        pattern, suffix = pattern[:-4], "(?:/.*)?"
+    prefix = "" if anchored else "(?:.*/)?"
+    return prefix + _wildcards(pattern) + suffix + r"\Z", dir_only
+
 
-    # Convert glob wildcards to regex equivalents
-    glob_pattern = glob_pattern.replace("*", ".*")
-    glob_pattern = glob_pattern.replace("?", ".")
+def compile_filter(rules):
+    """fuse ordered filter rules into a PathFilter with one regex for files and one for directories"""
+    files = []
+    dirs = []
+    for index, (action, pattern) in enumerate(rules):
+        regex, dir_only = glob_regex(pattern)
+        group = f"(?P<{'x' if action == '-' else 'i'}{index}>{regex})"
+        dirs.append(group)
+        if not dir_only:
+            files.append(group)
+    return PathFilter("|".join(files), "|".join(dirs))
 
-    # Anchor the pattern to match the whole string
-    regex_pattern = "^\\./" + glob_pattern + "$"
 
-    return regex_pattern
+def exclude_filter(rsync_args):
+    """return a PathFilter of the include and exclude rules in rsync args, or None if nothing is excluded"""
+    rules = rsync_filter_rules(rsync_args)
+    if not any(action == "-" for action, _ in rules):
+        return None
+    return compile_filter(rules)
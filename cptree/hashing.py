@@ -0,0 +1,443 @@
+# in-process hashing engine
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+BLOCK_SIZE = 1024 * 1024
+QUEUE_DEPTH = 4
+
+ESCAPE_CHARS = {"\\": "\\\\", "\n": "\\n", "\r": "\\r"}
+
+# mapped reads avoid a copy per block, but a file truncated while mapped raises SIGBUS
+USE_MMAP = False
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# tree hashes digest fixed-size chunks in parallel and combine them into a Merkle root
+TREE_SUFFIX = "-tree"
+TREE_CHUNK_SIZE = 64 * 1024 * 1024
+TREE_LEAF_PREFIX = b"\x00"
+TREE_NODE_PREFIX = b"\x01"
+
+# sampled hashes digest the size, head, tail and pseudo-random blocks chosen from the size alone
+SAMPLED_SUFFIX = "-sampled"
+SAMPLE_COUNT = 8
+SAMPLE_SIZE = 64 * 1024
+
+# stat digests are size and mtime only
+STAT_HASH = "stat"
+
+# run remotely, this module reads its own source and then a request from stdin
+AGENT_BOOTSTRAP = (
+    "import io, sys; "
+    "source = sys.stdin.buffer.read(int(sys.stdin.buffer.readline())); "
+    "agent = {'__name__': 'cptree_agent'}; "
+    "exec(compile(source, 'cptree_agent', 'exec'), agent); "
+    "agent['serve'](sys.stdin.buffer, io.TextIOWrapper(sys.stdout.buffer, 'utf-8', 'surrogateescape'))"
+)
+
+
+def default_workers():
+    """return the number of CPUs available to this process"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def is_tree_hash(hash):
+    return hash.endswith(TREE_SUFFIX)
+
+
+def is_sampled_hash(hash):
+    return hash.endswith(SAMPLED_SUFFIX)
+
+
+def is_flat_hash(hash):
+    return not (is_tree_hash(hash) or is_sampled_hash(hash) or hash == STAT_HASH)
+
+
+def base_hash(hash):
+    """return the hashlib algorithm underlying a hash name"""
+    for suffix in (TREE_SUFFIX, SAMPLED_SUFFIX):
+        if hash.endswith(suffix):
+            return hash[: -len(suffix)]
+    return hash
+
+
+def hash_tag(hash):
+    """return the BSD-style tag naming a hash in checksum output, including the parameters of derived hashes"""
+    if is_tree_hash(hash):
+        return f"{base_hash(hash).upper()}-TREE-{TREE_CHUNK_SIZE >> 20}M"
+    if is_sampled_hash(hash):
+        return f"{base_hash(hash).upper()}-SAMPLED-{SAMPLE_COUNT}X{SAMPLE_SIZE >> 10}K"
+    return hash.upper()
+
+
+def tag_line(tag, name, digest):
+    """return BSD-style checksum line, escaping the filename as GNU coreutils --tag does"""
+    if any(char in name for char in ESCAPE_CHARS):
+        escaped = "".join(ESCAPE_CHARS.get(char, char) for char in name)
+        return f"\\{tag} ({escaped}) = {digest}"
+    return f"{tag} ({name}) = {digest}"
+
+
+class PathFilter:
+    """test './'-relative names against rsync filter rules fused into regexes, the first matching rule deciding
+
+    Each alternative is a named group in rule order, starting with x for an
+    exclude rule and i for an include rule; dirs also holds the rules that
+    only match directories.  Directory names end with '/'.  Calling the
+    filter tests the name alone, as a walker pruning excluded directories
+    needs, while excludes_path() also tests each parent directory.  It is
+    kept here, with the patterns from exclude.compile_filter, so the remote
+    agent can apply it.
+    """
+
+    def __init__(self, files, dirs):
+        self.patterns = [files, dirs]
+        self.files = re.compile(files, re.DOTALL) if files else None
+        self.dirs = re.compile(dirs, re.DOTALL) if dirs else None
+
+    def __call__(self, name):
+        if name.startswith("./"):
+            name = name[2:]
+        if name.endswith("/"):
+            regex, name = self.dirs, name[:-1]
+        else:
+            regex = self.files
+        if regex is None or not name:
+            return False
+        match = regex.match(name)
+        return match is not None and match.lastgroup[0] == "x"
+
+    def excludes_path(self, name):
+        """return True if a name or any of its parent directories is excluded"""
+        parts = name.split("/")
+        for index in range(1, len(parts)):
+            if self("/".join(parts[:index]) + "/"):
+                return True
+        return self(name)
+
+
+def walk_files(base, exclude=None, cancel=None):
+    """yield './'-relative names of regular files below base, as 'find . -type f' would
+
+    exclude is called with each name, directories with a trailing '/', and
+    prunes matching directories.  Setting the cancel event ends the walk
+    before the next directory.
+    """
+    dirs = ["."]
+    while dirs and not (cancel is not None and cancel.is_set()):
+        dir = dirs.pop()
+        with os.scandir(os.path.join(base, dir)) as entries:
+            for entry in entries:
+                name = dir + "/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if exclude is None or not exclude(name + "/"):
+                        dirs.append(name)
+                elif entry.is_file(follow_symlinks=False):
+                    if exclude is None or not exclude(name):
+                        yield name
+
+
+_buffers = threading.local()
+
+
+def _read_buffer():
+    """return this thread's reusable read buffer"""
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _buffers.buffer = memoryview(bytearray(BLOCK_SIZE))
+    return buffer
+
+
+def digest_range(ifp, digests, offset=0, length=None, use_mmap=None):
+    """update each digest from a byte range of an unbuffered binary file, reading it once
+
+    Blocks are read with readinto() into a per-thread buffer, or taken from
+    a memory map of large ranges when use_mmap is set, with sequential
+    read-ahead hints in both cases.
+    """
+    fd = ifp.fileno()
+    size = os.fstat(fd).st_size
+    end = size if length is None else min(size, offset + length)
+    if end <= offset:
+        return
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, end - offset, os.POSIX_FADV_SEQUENTIAL)
+    if use_mmap is None:
+        use_mmap = USE_MMAP
+    if use_mmap and end - offset >= MMAP_THRESHOLD:
+        _digest_mmap(fd, digests, offset, end)
+        return
+    buffer = _read_buffer()
+    ifp.seek(offset)
+    remaining = end - offset
+    while remaining > 0:
+        count = ifp.readinto(buffer[: min(BLOCK_SIZE, remaining)])
+        if not count:
+            break
+        remaining -= count
+        block = buffer[:count]
+        for digest in digests:
+            digest.update(block)
+        block.release()
+
+
+def _digest_mmap(fd, digests, offset, end):
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with mmap.mmap(fd, end - start, access=mmap.ACCESS_READ, offset=start) as mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for pos in range(offset - start, end - start, BLOCK_SIZE):
+                block = view[pos : pos + BLOCK_SIZE]  # noqa: E203
+                for digest in digests:
+                    digest.update(block)
+                block.release()
+
+
+def hash_file(path, hashes, use_mmap=None):
+    """return hex digests of file contents for each hash, computed from a single read of the file"""
+    digests = [hashlib.new(hash) for hash in hashes]
+    with open(path, "rb", buffering=0) as ifp:
+        digest_range(ifp, digests, use_mmap=use_mmap)
+    return [digest.hexdigest() for digest in digests]
+
+
+def bounded_map(func, items, workers=None):
+    """apply func to items in a thread pool, yielding results as completed with a bounded number in flight"""
+    workers = workers or default_workers()
+    limit = workers * QUEUE_DEPTH
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        try:
+            for item in items:
+                pending.add(executor.submit(func, item))
+                if len(pending) >= limit:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _until(cancel, names):
+    """yield names until the cancel event is set"""
+    for name in names:
+        if cancel.is_set():
+            return
+        yield name
+
+
+def hash_files(base, names, hashes, workers=None, cancel=None):
+    """hash each named file below base in a worker pool, yielding (name, digests) in completion order
+
+    Once the cancel event is set no more files are started, and only those
+    already queued are finished.
+    """
+
+    if cancel is not None:
+        names = _until(cancel, names)
+    if not all(is_flat_hash(hash) for hash in hashes):
+        return FileHasher(base, hashes, workers).hash_files(names)
+
+    def _hash(name):
+        return name, hash_file(os.path.join(base, name), hashes)
+
+    return bounded_map(_hash, names, workers)
+
+
+def merkle_root(hash, leaves):
+    """return hex Merkle root of leaf digests, promoting the odd node at each level"""
+    nodes = leaves
+    while len(nodes) > 1:
+        pairs = range(0, len(nodes) - 1, 2)
+        level = [hashlib.new(hash, TREE_NODE_PREFIX + nodes[i] + nodes[i + 1]).digest() for i in pairs]
+        if len(nodes) % 2:
+            level.append(nodes[-1])
+        nodes = level
+    return nodes[0].hex()
+
+
+def sample_offsets(size):
+    """return sorted offsets of the sampled blocks of a file, covering the whole file when it is small"""
+    if size <= (SAMPLE_COUNT + 2) * SAMPLE_SIZE:
+        return list(range(0, size, SAMPLE_SIZE))
+    span = size - SAMPLE_SIZE
+    offsets = {0, span}
+    for index in range(SAMPLE_COUNT):
+        seed = hashlib.sha256(f"{size}:{index}".encode()).digest()
+        offsets.add(int.from_bytes(seed[:8], "big") % span)
+    return sorted(offsets)
+
+
+def stat_digest(stat):
+    return f"{stat.st_size}-{int(stat.st_mtime)}"
+
+
+class FileHasher:
+    """hash files with a mix of flat, tree, sampled and stat hashes
+
+    The chunks of files larger than TREE_CHUNK_SIZE are spread across the
+    worker pool when tree hashes are requested.
+    """
+
+    def __init__(self, base, hashes, workers=None):
+        self.base = base
+        self.hashes = hashes
+        self.flat = [hash for hash in hashes if is_flat_hash(hash)]
+        self.tree = [base_hash(hash) for hash in hashes if is_tree_hash(hash)]
+        self.sampled = [base_hash(hash) for hash in hashes if is_sampled_hash(hash)]
+        self.stat = STAT_HASH in hashes
+        self.workers = workers or default_workers()
+
+    def _leaves(self, ifp, offset, length, flat=()):
+        """return leaf digests of a byte range, updating any flat digests from the same reads"""
+        leaves = [hashlib.new(hash, TREE_LEAF_PREFIX) for hash in self.tree]
+        digest_range(ifp, leaves + list(flat), offset, length)
+        return [leaf.digest() for leaf in leaves]
+
+    def _samples(self, ifp, size):
+        """return sampled hex digests of an open file"""
+        digests = [hashlib.new(hash, size.to_bytes(8, "big")) for hash in self.sampled]
+        for offset in sample_offsets(size):
+            digest_range(ifp, digests, offset, SAMPLE_SIZE)
+        return [digest.hexdigest() for digest in digests]
+
+    def _whole(self, name):
+        """hash a file that fits in one chunk, or report the size of a file to be split"""
+        path = os.path.join(self.base, name)
+        if not (self.flat or self.tree or self.sampled):
+            return "done", name, self._digests([], [], [], os.stat(path, follow_symlinks=False))
+        with open(path, "rb", buffering=0) as ifp:
+            stat = os.fstat(ifp.fileno())
+            samples = self._samples(ifp, stat.st_size) if self.sampled else []
+            if self.tree and stat.st_size > TREE_CHUNK_SIZE:
+                return "split", name, (stat, samples)
+            flat = [hashlib.new(hash) for hash in self.flat]
+            leaves = self._leaves(ifp, 0, stat.st_size, flat)
+        flat = [digest.hexdigest() for digest in flat]
+        return "done", name, self._digests(flat, [[leaf] for leaf in leaves], samples, stat)
+
+    def _flat(self, name):
+        return "flat", name, hash_file(os.path.join(self.base, name), self.flat)
+
+    def _chunk(self, name, index):
+        with open(os.path.join(self.base, name), "rb", buffering=0) as ifp:
+            return "chunk", name, (index, self._leaves(ifp, index * TREE_CHUNK_SIZE, TREE_CHUNK_SIZE))
+
+    def _digests(self, flat, leaves, samples, stat):
+        """return digests ordered as self.hashes"""
+        flat = iter(flat)
+        roots = iter([merkle_root(hash, hash_leaves) for hash, hash_leaves in zip(self.tree, leaves)])
+        samples = iter(samples)
+        digests = []
+        for hash in self.hashes:
+            if is_tree_hash(hash):
+                digests.append(next(roots))
+            elif is_sampled_hash(hash):
+                digests.append(next(samples))
+            elif hash == STAT_HASH:
+                digests.append(stat_digest(stat))
+            else:
+                digests.append(next(flat))
+        return digests
+
+    def _split(self, executor, name, stat, samples):
+        """start hashing the chunks of a large file, returning its state and futures"""
+        count = -(-stat.st_size // TREE_CHUNK_SIZE)
+        state = dict(stat=stat, samples=samples, flat=None, chunks=[None] * count, remaining=count + bool(self.flat))
+        futures = [executor.submit(self._chunk, name, index) for index in range(count)]
+        if self.flat:
+            futures.append(executor.submit(self._flat, name))
+        return state, futures
+
+    def _merge(self, state, kind, result):
+        """add a chunk or flat result to a split file's state, returning its digests once all have arrived"""
+        if kind == "flat":
+            state["flat"] = result
+        else:
+            index, leaves = result
+            state["chunks"][index] = leaves
+        state["remaining"] -= 1
+        if state["remaining"]:
+            return None
+        leaves = [list(hash_leaves) for hash_leaves in zip(*state["chunks"])]
+        return self._digests(state["flat"] or [], leaves, state["samples"], state["stat"])
+
+    def hash_files(self, names):
+        names = iter(names)
+        limit = self.workers * QUEUE_DEPTH
+        split = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            try:
+                while True:
+                    for name in names:
+                        pending.add(executor.submit(self._whole, name))
+                        if len(pending) >= limit:
+                            break
+                    if not pending:
+                        return
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        kind, name, result = future.result()
+                        if kind == "split":
+                            split[name], futures = self._split(executor, name, *result)
+                            pending.update(futures)
+                            continue
+                        digests = result if kind == "done" else self._merge(split[name], kind, result)
+                        if digests is not None:
+                            split.pop(name, None)
+                            yield name, digests
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+def _read_names(in_stream):
+    """yield NUL-delimited names read from a binary stream"""
+    partial = b""
+    while True:
+        data = in_stream.read(BLOCK_SIZE)
+        if not data:
+            break
+        names = (partial + data).split(b"\0")
+        partial = names.pop()
+        for name in names:
+            yield os.fsdecode(name)
+    if partial:
+        yield os.fsdecode(partial)
+
+
+def serve(in_stream, out_stream):
+    """hash files as a remote agent, writing BSD-style lines for every requested hash
+
+    in_stream, after the source sent by AGENT_BOOTSTRAP, holds a JSON
+    request line with base, hashes and optional PathFilter patterns, then
+    the NUL-delimited names to hash if the request sets files, otherwise
+    all files below base are hashed.
+    """
+    request = json.loads(in_stream.readline())
+    base = request["base"]
+    hashes = request["hashes"]
+    if request.get("files"):
+        names = _read_names(in_stream)
+    else:
+        exclude = request.get("exclude")
+        names = walk_files(base, PathFilter(*exclude) if exclude else None)
+    tags = [hash_tag(hash) for hash in hashes]
+    for name, digests in hash_files(base, names, hashes, request.get("workers")):
+        for tag, digest in zip(tags, digests):
+            out_stream.write(tag_line(tag, name, digest) + "\n")
+    out_stream.flush()
@@ -0,0 +1,172 @@
+# compact inventory of prescan items
+
+import heapq
+import sys
+from array import array
+
+FILE_TYPES = "d-lpcbs"
+
+# files at least this large are spread across shards individually, smaller ones in batches
+SHARD_LARGE_SIZE = 64 * 1024 * 1024
+SHARD_BATCH_SIZE = 1000
+
+# names round-trip undecodable bytes as rsync's listing is read
+ENCODING = ("utf-8", "surrogateescape")
+
+
+class Entry:
+    """view of one inventory item"""
+
+    __slots__ = ("inventory", "index")
+
+    def __init__(self, inventory, index):
+        self.inventory = inventory
+        self.index = index
+
+    @property
+    def type(self):
+        return chr(self.inventory.types[self.index])
+
+    @property
+    def size(self):
+        return self.inventory.sizes[self.index]
+
+    @property
+    def name(self):
+        return self.inventory.name(self.index)
+
+    def __repr__(self):
+        return f"Entry(type={self.type!r}, size={self.size}, name={self.name!r})"
+
+
+class Inventory:
+    """array-backed list of (type, size, name) items from an rsync listing
+
+    Directory prefixes are interned, sizes, type codes and name offsets are
+    packed into arrays, and base names are concatenated into one bytearray,
+    so each item costs tens of bytes rather than a string per field.
+    """
+
+    def __init__(self):
+        self.dirs = []
+        self.dir_ids = {}
+        self.parents = array("L")
+        self.sizes = array("Q")
+        self.types = bytearray()
+        self.names = bytearray()
+        self.offsets = array("Q", [0])
+        self.counts = {file_type: 0 for file_type in FILE_TYPES}
+        self.total_size = 0
+
+    def tally(self, file_type, size):
+        """count an item without storing it"""
+        self.counts[file_type] += 1
+        self.total_size += size
+
+    def add(self, file_type, size, name):
+        """store an item, as listed relative to the transfer root"""
+        self.tally(file_type, size)
+        dir, _, base = name.rpartition("/")
+        dir_id = self.dir_ids.get(dir)
+        if dir_id is None:
+            dir_id = self.dir_ids[dir] = len(self.dirs)
+            self.dirs.append(sys.intern(dir))
+        self.parents.append(dir_id)
+        self.sizes.append(size)
+        self.types.append(ord(file_type))
+        self.names += base.encode(*ENCODING)
+        self.offsets.append(len(self.names))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return Entry(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Entry(self, index)
+
+    @property
+    def item_count(self):
+        return sum(self.counts.values())
+
+    def name(self, index):
+        """return the transfer-relative name of an item"""
+        base = self.names[self.offsets[index] : self.offsets[index + 1]].decode(*ENCODING)  # noqa: E203
+        dir = self.dirs[self.parents[index]]
+        return f"{dir}/{base}" if dir else base
+
+    def files(self):
+        """yield './'-relative names of regular files"""
+        regular = ord("-")
+        for index, file_type in enumerate(self.types):
+            if file_type == regular:
+                yield "./" + self.name(index)
+
+    def write_files(self, filename):
+        """write './'-relative names of regular files, one per line"""
+        with open(filename, "w", errors="surrogateescape") as ofp:
+            for name in self.files():
+                ofp.write(name + "\n")
+
+    def shard(self, count, large_size=SHARD_LARGE_SIZE, batch_size=SHARD_BATCH_SIZE):
+        """return an array assigning each item to one of count shards of balanced size
+
+        Large regular files are placed, largest first, on the least loaded
+        shard.  Smaller files follow in batches of neighbouring files closed
+        at batch_size files or large_size bytes.  Directories, links and
+        special files all stay in shard 0, so one process creates them.
+        """
+        shards = array("H", bytes(2 * len(self)))
+        loads = [(0, index) for index in range(count)]
+        regular = ord("-")
+        large = [
+            index
+            for index, file_type in enumerate(self.types)
+            if file_type == regular and self.sizes[index] >= large_size
+        ]
+        large.sort(key=self.sizes.__getitem__, reverse=True)
+        for index in large:
+            load, shard = heapq.heappop(loads)
+            shards[index] = shard
+            heapq.heappush(loads, (load + self.sizes[index], shard))
+        batch = []
+        batch_bytes = 0
+        for index, file_type in enumerate(self.types):
+            if file_type != regular or self.sizes[index] >= large_size:
+                continue
+            batch.append(index)
+            batch_bytes += self.sizes[index]
+            if len(batch) >= batch_size or batch_bytes >= large_size:
+                self._assign(shards, loads, batch, batch_bytes)
+                batch = []
+                batch_bytes = 0
+        if batch:
+            self._assign(shards, loads, batch, batch_bytes)
+        return shards
+
+    @staticmethod
+    def _assign(shards, loads, batch, batch_bytes):
+        load, shard = heapq.heappop(loads)
+        for index in batch:
+            shards[index] = shard
+        heapq.heappush(loads, (load + batch_bytes, shard))
+
+    def write_shard(self, filename, shards, shard):
+        """write NUL-delimited names of the items in one shard, as rsync --files-from --from0 reads them"""
+        with open(filename, "wb") as ofp:
+            for index, item_shard in enumerate(shards):
+                if item_shard == shard:
+                    ofp.write(self.name(index).encode(*ENCODING) + b"\0")
+
+    def nbytes(self):
+        """return approximate memory used by item storage"""
+        arrays = (self.parents, self.sizes, self.offsets)
+        size = sum(a.buffer_info()[1] * a.itemsize for a in arrays) + len(self.types) + len(self.names)
+        size += sum(sys.getsizeof(dir) for dir in self.dirs) + sys.getsizeof(self.dir_ids)
+        return size
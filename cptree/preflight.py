@@ -0,0 +1,54 @@
+# single round trip host preflight
+
+from .common import resolver
+from .exceptions import PreflightFailed
+from .process import run
+
+
+class Preflight:
+    """directory state and command paths reported by one host's preflight script"""
+
+    def __init__(self, host):
+        self.host = host
+        self.dirs = {}
+        self.commands = {}
+
+
+def preflight_script(dirs, commands):
+    """return a shell script printing one 'KIND ...' line per directory test and command path"""
+    lines = []
+    for index, dir in enumerate(dirs):
+        lines.append(f'if [ -d {dir} ]; then echo "dir {index} 1"; else echo "dir {index} 0"; fi')
+    if commands:
+        lines.append(resolver.probe_script(commands))
+    return "; ".join(lines)
+
+
+def preflight(host, dirs=(), commands=()):
+    """test dirs and resolve commands on host with a single command
+
+    Only commands not already known to the command resolver are probed, and
+    the paths found are passed to it, so later which() calls need no round
+    trip.  Nothing is run if there is nothing to do.
+    """
+    dirs = list(dict.fromkeys(str(dir) for dir in dirs))
+    result = Preflight(host)
+    commands = resolver.unresolved(commands, host)
+    if not (dirs or commands):
+        return result
+
+    proc = run(preflight_script(dirs, commands), host=host, warn=True)
+    lines = proc.stdout.splitlines()
+    for line in lines:
+        kind, _, value = line.partition(" ")
+        if kind == "dir":
+            index, _, exists = value.partition(" ")
+            result.dirs[dirs[int(index)]] = exists == "1"
+
+    if len(result.dirs) != len(dirs):
+        raise PreflightFailed(f"preflight failed on {host or 'localhost'}: {proc.stderr}")
+
+    if commands:
+        result.commands = resolver.parse_probe(commands, lines)
+        resolver.remember(host, result.commands)
+    return result
@@ -0,0 +1,290 @@
+# streaming process runner
+
+import atexit
+import codecs
+import io
+import os
+import shlex
+import signal
+import subprocess
+import threading
+from collections import deque
+
+import click
+import fabric
+
+from .exceptions import CommandFailed
+
+CHUNK_SIZE = 64 * 1024
+STDERR_TAIL_LINES = 100
+CANCEL_POLL_INTERVAL = 0.1
+ENCODING = "utf-8"
+
+# shell exit codes of a command that was not found or is not executable
+NOT_FOUND_EXIT_CODES = (126, 127)
+
+_not_found_handlers = []
+
+
+def _decoder():
+    return codecs.getincrementaldecoder(ENCODING)(errors="surrogateescape")
+
+
+def on_command_not_found(handler):
+    """call handler(host) whenever a command exits with one of NOT_FOUND_EXIT_CODES"""
+    _not_found_handlers.append(handler)
+
+
+class ConnectionPool:
+    """ssh connections opened once per host and shared by every remote command of a run
+
+    factory(host) returns an unopened connection, a fabric.Connection by
+    default.  Each remote command runs in its own session channel of the
+    host's connection, so concurrent commands share one transport.
+    """
+
+    def __init__(self, factory=fabric.Connection):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def get(self, host):
+        """return the open connection to host, connecting on first use"""
+        with self.lock:
+            connection = self.connections.get(host)
+            if connection is None or not connection.is_connected:
+                connection = self.factory(host)
+                connection.open()
+                self.connections[host] = connection
+            return connection
+
+    def close(self):
+        """close every pooled connection"""
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+connections = ConnectionPool()
+atexit.register(connections.close)
+
+
+class LineSplitter:
+    """assemble output chunks into complete lines, split on newline or carriage return
+
+    Each chunk is split once and its complete lines, which may include empty
+    ones, are passed to the callback as a list.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.decoder = _decoder()
+        self.partial = ""
+
+    def feed(self, data, final=False):
+        text = self.partial + self.decoder.decode(data, final)
+        if "\r" in text:
+            text = text.replace("\r", "\n")
+        lines = text.split("\n")
+        self.partial = "" if final else lines.pop()
+        if lines:
+            self.callback(lines)
+
+
+class Result:
+    """exit status, captured stdout and stderr tail of a finished command"""
+
+    def __init__(self, command, return_code, stdout, stderr):
+        self.command = command
+        self.return_code = return_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.ok
+
+
+class Process:
+    """local or remote command whose output is read in fixed-size chunks
+
+    Blocks of complete stdout lines are fed to each watcher's feed_lines(),
+    stdout data is copied to out_stream, and only when there are neither is
+    stdout kept for the result.  Only the last STDERR_TAIL_LINES lines of stderr are kept, so
+    memory stays flat however long the command runs.  in_stream, a text or
+    binary file, is copied to the command's stdin.  Setting the cancel
+    event kills the command while join() waits for it.
+    """
+
+    def __init__(
+        self,
+        command,
+        host=None,
+        *,
+        watchers=(),
+        in_stream=None,
+        out_stream=None,
+        env=None,
+        warn=False,
+        cancel=None,
+    ):
+        self.command = command
+        self.host = host
+        self.watchers = list(watchers)
+        self.in_stream = in_stream
+        self.out_stream = out_stream
+        self.warn = warn
+        self.cancel = cancel
+        self.stdout = [] if not (watchers or out_stream) else None
+        self.stderr = deque(maxlen=STDERR_TAIL_LINES)
+        self.out_decoder = _decoder()
+        self.stdout_lines = LineSplitter(self._stdout_lines)
+        self.stderr_lines = LineSplitter(self._stderr_lines)
+        if host:
+            self._start_remote(env)
+        else:
+            self._start_local(env)
+        self.threads = [
+            threading.Thread(target=self._pump, args=(self.read_stdout, self._stdout_data), daemon=True),
+            threading.Thread(target=self._pump, args=(self.read_stderr, self.stderr_lines.feed), daemon=True),
+        ]
+        if in_stream:
+            self.threads.append(threading.Thread(target=self._send, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def _start_local(self, env):
+        if env:
+            env = dict(os.environ, **env)
+        self.proc = subprocess.Popen(
+            self.command,
+            shell=True,
+            stdin=subprocess.PIPE if self.in_stream else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            # a cancellable command is killed with all of its children
+            start_new_session=self.cancel is not None,
+        )
+        self.read_stdout = lambda: os.read(self.proc.stdout.fileno(), CHUNK_SIZE)
+        self.read_stderr = lambda: os.read(self.proc.stderr.fileno(), CHUNK_SIZE)
+        self.write_stdin = self.proc.stdin.write if self.in_stream else None
+        self.close_stdin = self.proc.stdin.close if self.in_stream else None
+        self.wait = self.proc.wait
+        self.kill = self._kill_session
+
+    def _start_remote(self, env):
+        command = self.command
+        if env:
+            exports = " ".join(f"{key}={shlex.quote(value)}" for key, value in env.items())
+            command = f"export {exports}; {command}"
+        self.channel = connections.get(self.host).client.get_transport().open_session()
+        self.channel.exec_command(command)
+        if not self.in_stream:
+            self.channel.shutdown_write()
+        self.read_stdout = lambda: self.channel.recv(CHUNK_SIZE)
+        self.read_stderr = lambda: self.channel.recv_stderr(CHUNK_SIZE)
+        self.write_stdin = self.channel.sendall
+        self.close_stdin = self.channel.shutdown_write
+        self.wait = self.channel.recv_exit_status
+        self.kill = self.channel.close
+
+    def _pump(self, read, handle):
+        while True:
+            data = read()
+            if not data:
+                break
+            handle(data)
+        handle(b"", final=True)
+
+    def _send(self):
+        try:
+            while True:
+                data = self.in_stream.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if isinstance(data, str):
+                    data = data.encode(ENCODING, errors="surrogateescape")
+                self.write_stdin(data)
+        except (BrokenPipeError, OSError):
+            # the command exited without reading all of its input
+            pass
+        finally:
+            try:
+                self.close_stdin()
+            except OSError:
+                pass
+
+    def _stdout_data(self, data, final=False):
+        if self.stdout is not None:
+            self.stdout.append(data)
+        if self.out_stream is not None:
+            if isinstance(self.out_stream, io.TextIOBase):
+                self.out_stream.write(self.out_decoder.decode(data, final))
+            else:
+                self.out_stream.write(data)
+        if self.watchers:
+            self.stdout_lines.feed(data, final)
+
+    def _stdout_lines(self, lines):
+        for watcher in self.watchers:
+            watcher.feed_lines(lines)
+
+    def _stderr_lines(self, lines):
+        self.stderr.extend(line for line in lines if line)
+
+    def _kill_session(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _exited(self, timeout):
+        if self.host:
+            return self.channel.status_event.wait(timeout)
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        return True
+
+    def join(self):
+        """wait for the command to finish, returning its Result or raising CommandFailed unless warn is set"""
+        if self.cancel is not None:
+            while not self._exited(CANCEL_POLL_INTERVAL):
+                if self.cancel.is_set():
+                    self.kill()
+                    break
+        return_code = self.wait()
+        for thread in self.threads:
+            thread.join()
+        if self.host:
+            self.channel.close()
+        else:
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+        stdout = b"".join(self.stdout).decode(ENCODING, errors="surrogateescape") if self.stdout is not None else ""
+        result = Result(self.command, return_code, stdout, "\n".join(self.stderr))
+        if return_code in NOT_FOUND_EXIT_CODES:
+            for handler in _not_found_handlers:
+                handler(self.host)
+        if result.failed and not self.warn:
+            raise CommandFailed(f"{self.command!r} failed with exit code {return_code}: {result.stderr}")
+        return result
+
+
+def start(command, host=None, *, echo=False, **kwargs):
+    """start a local command, or a remote one if host is given, returning its Process"""
+    if echo:
+        click.echo(command)
+    return Process(command, host, **kwargs)
+
+
+def run(command, host=None, **kwargs):
+    """run a command to completion, returning its Result"""
+    return start(command, host, **kwargs).join()
@@ -1,9 +1,75 @@
 import io
 import sys
+import threading
+import time
 from pathlib import Path
 
 from tqdm import tqdm
 
+REFRESH_RATE = 10
+
+
+class ProgressAggregator:
+    """accumulate progress from any thread, passing it to a tqdm bar at most rate times per second
+
+    Deltas of the bar's count and total and of an item count are summed
+    under a lock and flushed together.  describe, if given, formats the bar
+    description from the item count at each flush, so nothing is formatted
+    between flushes.  close() flushes whatever is still pending.
+    """
+
+    def __init__(self, bar, rate=REFRESH_RATE, describe=None):
+        self.bar = bar
+        self.interval = 1 / rate
+        self.describe = describe
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0
+        self.items = 0
+        self.pending_items = 0
+        self.next_flush = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def update(self, count=0, items=0):
+        with self.lock:
+            self.count += count
+            self.pending_items += items
+            if time.monotonic() >= self.next_flush:
+                self._flush()
+
+    def add_total(self, total):
+        with self.lock:
+            self.total += total
+            if time.monotonic() >= self.next_flush:
+                self._flush()
+
+    def _flush(self):
+        self.next_flush = time.monotonic() + self.interval
+        if self.total:
+            self.bar.total = (self.bar.total or 0) + self.total
+            self.total = 0
+        if self.pending_items:
+            self.items += self.pending_items
+            self.pending_items = 0
+            if self.describe is not None:
+                self.bar.set_description(self.describe(self.items), refresh=False)
+        count, self.count = self.count, 0
+        self.bar.update(count)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.bar.close()
+
 
 class ProgressReader:
     def __init__(self, in_stream, **kwargs):
@@ -57,8 +123,6 @@ class ProgressReader:
 
 
 if __name__ == "__main__":
-    import time
-
     import click
 
     @click.command("progress")
@@ -5,38 +5,43 @@ from pathlib import Path
 from time import sleep
 
 import click
-from fabric import Connection
-from invoke import run
 
-from .common import split_target
+from .common import runner, split_target
 from .exceptions import InvalidDirectory
+from .preflight import preflight
 
 DELETE_COUNTDOWN = 10
 
 
-def _verify_directory(host, target, dir_type, create=None, delete=None):
+def _local_path(host, target):
+    """return target with a local '~' expanded, as tested and created"""
+    target = str(target)
+    if not host and "~" in target:
+        target = str(Path(os.path.expanduser(target)).resolve())
+    return target
+
+
+def _verify_directory(host, target, dir_type, create=None, delete=None, exists=None):
     target = str(target)
     if host:
         label = f"Remote {dir_type} {host}:{target}"
-        runner = Connection(host).run
         if dir_type == "output":
             raise InvalidDirectory("Unsupported: " + label)
         if "~" in str(target):
             raise InvalidDirectory("Illegal '~' expansion: " + label)
     else:
-        if "~" in str(target):
-            target = os.path.expanduser(str(target))
-            target = str(Path(target).resolve())
+        target = _local_path(host, target)
         label = f"Local {dir_type} {target}"
-        runner = run
 
-    result = runner(f"[ -d {target} ]", warn=True, hide=True)
-    if result.failed:
+    run = runner(host)
+    if exists is None:
+        exists = run(f"[ -d {target} ]", warn=True).ok
+    if not exists:
         # doesn't exist, check for create
         if (dir_type in ["destination", "output"]) and (create in ["ask", "force", True]):
             if create == "ask":
                 click.confirm(f"{label} does not exist. Create it?", abort=True)
-            runner(f"mkdir -p {target}", echo=True)
+            run(f"mkdir -p {target}", echo=True)
         elif dir_type != "destination":
             # not created, all but DST must exist
             raise InvalidDirectory(label)
@@ -49,7 +54,7 @@ def _verify_directory(host, target, dir_type, create=None, delete=None):
             True,
         ]:
             cmd = confirm_delete(target, label, host, delete)
-            runner(cmd, echo=True)
+            run(cmd, echo=True)
 
 
 def confirm_delete(target, label, host, delete):
@@ -69,22 +74,48 @@ def delete_countdown(msg, cmd, host):
         sleep(1)
 
 
-def verify_output_directory(target):
+def verify_output_directory(target, exists=None):
     host, target = split_target(target)
-    return _verify_directory(host, target, "output", "ask", None)
+    return _verify_directory(host, target, "output", "ask", None, exists)
 
 
-def verify_src_directory(target):
+def verify_src_directory(target, exists=None):
     host, target = split_target(target)
-    return _verify_directory(host, target, "source", None, None)
+    return _verify_directory(host, target, "source", None, None, exists)
 
 
-def verify_dst_directory(target, create=None, delete=None):
+def verify_dst_directory(target, create=None, delete=None, exists=None):
+    """verify the parent of DST, and DST itself if it is to be deleted; exists maps each tested dir to its state"""
     if delete:
         create = None
+    exists = exists or {}
     host, target = split_target(target)
     # verify parent of DST dir exists
-    _verify_directory(host, Path(target).parent, "destination", create, False)
+    parent = Path(target).parent
+    _verify_directory(host, parent, "destination", create, False, exists.get(_local_path(host, parent)))
     if delete:
         # delete target dir
-        _verify_directory(host, target, "destination", None, delete)
+        _verify_directory(host, target, "destination", None, delete, exists.get(_local_path(host, target)))
+
+
+def verify_directories(src, dst, output_dir, create=None, delete=None, commands=None):
+    """verify the output, source and destination directories with one preflight per host
+
+    commands maps hosts to commands resolved by the same preflight.  Only
+    creating or deleting a directory, after any confirmation, needs another
+    round trip.
+    """
+    src_host, src_dir = split_target(src)
+    dst_host, dst_dir = split_target(dst)
+    output_host, output_path = split_target(output_dir)
+    checks = [(output_host, output_path), (src_host, src_dir), (dst_host, Path(dst_dir).parent)]
+    if delete:
+        checks.append((dst_host, dst_dir))
+    dirs = {host: [] for host in commands or {}}
+    for host, target in checks:
+        dirs.setdefault(host, []).append(_local_path(host, target))
+    results = {host: preflight(host, host_dirs, (commands or {}).get(host, ())) for host, host_dirs in dirs.items()}
+
+    verify_output_directory(output_dir, results[output_host].dirs[_local_path(output_host, output_path)])
+    verify_src_directory(src, results[src_host].dirs[_local_path(src_host, src_dir)])
+    verify_dst_directory(dst, create, delete, results[dst_host].dirs)
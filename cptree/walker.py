@@ -0,0 +1,72 @@
+# parallel local directory walker
+
+import os
+import stat
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# metadata latency rather than CPU bounds a walk of network filesystems
+WALK_WORKERS = 32
+QUEUE_DEPTH = 4
+
+FILE_MODES = [
+    (stat.S_ISDIR, "d"),
+    (stat.S_ISREG, "-"),
+    (stat.S_ISLNK, "l"),
+    (stat.S_ISFIFO, "p"),
+    (stat.S_ISCHR, "c"),
+    (stat.S_ISBLK, "b"),
+    (stat.S_ISSOCK, "s"),
+]
+
+
+def file_type(mode):
+    """return the rsync --list-only type character of a stat mode"""
+    for test, code in FILE_MODES:
+        if test(mode):
+            return code
+    return "-"
+
+
+def _scan(base, dir, exclude):
+    """return (records, subdirectories) of one directory, names relative to base"""
+    records = []
+    subdirs = []
+    prefix = "" if dir == "." else dir + "/"
+    with os.scandir(os.path.join(base, dir)) as entries:
+        for entry in entries:
+            name = prefix + entry.name
+            if exclude is not None and exclude("./" + name + ("/" if entry.is_dir(follow_symlinks=False) else "")):
+                continue
+            info = entry.stat(follow_symlinks=False)
+            code = file_type(info.st_mode)
+            records.append((code, info.st_size, name))
+            if code == "d":
+                subdirs.append(name)
+    return records, subdirs
+
+
+def walk_tree(base, exclude=None, workers=WALK_WORKERS):
+    """yield (type, size, name) for base and everything below it, as rsync --list-only reports them
+
+    Sibling directories are scanned concurrently, so records arrive in no
+    particular order.  exclude is called with './'-relative names,
+    directories with a trailing '/', and prunes matching directories.
+    """
+    base = str(base)
+    yield "d", os.stat(base).st_size, "."
+    limit = workers * QUEUE_DEPTH
+    dirs = ["."]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        try:
+            while dirs or pending:
+                while dirs and len(pending) < limit:
+                    pending.add(executor.submit(_scan, base, dirs.pop(), exclude))
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    records, subdirs = future.result()
+                    dirs.extend(subdirs)
+                    yield from records
+        finally:
+            for future in pending:
+                future.cancel()
@@ -1,55 +1,59 @@
-# invoke watcher
+# rsync output line watcher
 
-import re
-from typing import Generator
 
-from invoke.watchers import StreamWatcher
+class LineWatcher:
+    """dispatch rsync output lines to file, progress and other line callbacks
 
-from .common import parse_int
+    Lines starting with '~' are --out-format file lines, lines whose second
+    field is a percentage are --info=progress2 updates, and anything else is
+    passed to line_callback.
+    """
 
-
-class LineWatcher(StreamWatcher):
     def __init__(self, *, file_callback=None, progress_callback=None, line_callback=None):
-        self.index = 0
-        self.file_pattern = re.compile(r"^~([^\s]+)\s([0-9,]+)\s(.*)")
-        self.percent_pattern = re.compile(r"^\s*([^\s]+)\s+([0-9\.]+)%")
         self.file_callback = file_callback
         self.progress_callback = progress_callback
         self.line_callback = line_callback
         self.file_count = 0
         self.byte_count = 0
-        super().__init__()
 
-    def parse_line(self, line):
-        if self.line_callback:
-            return self.line_callback(line)
-        file = self.file_pattern.match(line)
-        if file:
-            codes, length, filename = file.groups()
-            self.file_count += 1
-            return self.file_callback(filename, self.file_count, parse_int(length), codes)
-        percent = self.percent_pattern.match(line)
-        if percent:
-            length, progress = percent.groups()
-            length = parse_int(length)
-            chunk = length - self.byte_count
-            self.byte_count = length
-            return self.progress_callback(chunk, progress)
+    def feed_lines(self, lines):  # noqa: C901
+        """handle a block of complete output lines
 
-    def submit(self, stream: str) -> Generator[str, None, None]:
-        while True:
-            try:
-                pos = stream.index("\n", self.index)
-            except ValueError:
-                try:
-                    pos = stream.index("\r", self.index)
-                except ValueError:
-                    return
-            chunk = stream[self.index : pos]  # noqa: E203
-            self.index = pos + 1
-            chunks = chunk.split("\n")
-            for chunk in chunks:
-                for line in chunk.split("\r"):
-                    if len(line):
-                        self.parse_line(line)
-        yield ""
+        Lines are dispatched on their first character and split with str
+        methods rather than matched with regular expressions, as rsync can
+        emit tens of thousands of lines per second.  Thousands separators
+        are only removed from numbers that have them.
+        """
+        file_callback = self.file_callback
+        progress_callback = self.progress_callback
+        line_callback = self.line_callback
+        for line in lines:
+            if not line:
+                continue
+            if file_callback is not None and line[0] == "~":
+                fields = line.split(" ", 2)
+                if len(fields) == 3 and len(fields[0]) > 1:
+                    length = fields[1]
+                    if not length.isdecimal() and "," in length:
+                        length = length.replace(",", "")
+                    if length.isdecimal():
+                        self.file_count += 1
+                        file_callback(fields[2], self.file_count, int(length), fields[0][1:])
+                        continue
+            elif progress_callback is not None:
+                fields = line.split(None, 2)
+                if len(fields) > 1 and fields[1][-1] == "%":
+                    length = fields[0]
+                    if not length.isdecimal() and "," in length:
+                        length = length.replace(",", "")
+                    if length.isdecimal():
+                        length = int(length)
+                        chunk = length - self.byte_count
+                        self.byte_count = length
+                        progress_callback(chunk, fields[1][:-1])
+                        continue
+            if line_callback is not None:
+                line_callback(line)
+
+    def parse_line(self, line):
+        self.feed_lines((line,))
@@ -1,10 +1,16 @@
 # global test config
 
+import importlib
+import json
 import os
+import subprocess
+import sys
 from pathlib import Path
 
 import pytest
 
+from cptree.process import connections
+
 
 @pytest.fixture
 def remote_host():
@@ -92,3 +98,172 @@ _test_targets = [
 @pytest.fixture
 def test_targets():
     return _test_targets
+
+
+class LocalChannel:
+    """session channel stand-in running its command locally"""
+
+    def exec_command(self, command):
+        self.proc = subprocess.Popen(
+            command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+    def recv(self, size):
+        return os.read(self.proc.stdout.fileno(), size)
+
+    def recv_stderr(self, size):
+        return os.read(self.proc.stderr.fileno(), size)
+
+    def sendall(self, data):
+        self.proc.stdin.write(data)
+
+    def shutdown_write(self):
+        self.proc.stdin.close()
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+
+
+class LocalConnection:
+    """ssh connection stand-in counting how often it is opened"""
+
+    opened = 0
+
+    def __init__(self, host):
+        self.host = host
+        self.is_connected = False
+        self.client = self
+
+    def open(self):
+        LocalConnection.opened += 1
+        self.is_connected = True
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return LocalChannel()
+
+    def close(self):
+        self.is_connected = False
+
+
+@pytest.fixture
+def local_connections(monkeypatch):
+    """run remote commands locally through a pool of connection stand-ins, counting connections in .opened"""
+    monkeypatch.setattr(connections, "factory", LocalConnection)
+    LocalConnection.opened = 0
+    yield LocalConnection
+    connections.close()
+
+
+STUB_RSYNC = """\
+# rsync stand-in copying the regular files and directories of a local tree
+# prints --list-only, --dry-run and --out-format lines as '~%i %l %n' would,
+# logs each call with its --files-from names, and exits 23 after copying
+# any file named fail*
+
+import json, os, shutil, sys
+
+VALUE_OPTIONS = ["--out-format", "--files-from", "--info", "-e", "--rsh", "--exclude", "--include"]
+
+
+def escape(name):
+    return "".join(f"\\\\#{ord(c):03o}" if ord(c) < 32 or ord(c) == 127 else c for c in name)
+
+
+def entries(src):
+    yield "d", "."
+    for dir, dirs, files in sorted(os.walk(src)):
+        dirs.sort()
+        rel = os.path.relpath(dir, src)
+        for name in dirs:
+            yield "d", os.path.normpath(os.path.join(rel, name))
+        for name in sorted(files):
+            yield "f", os.path.normpath(os.path.join(rel, name))
+
+
+def main(args):
+    options, values, paths = set(), {}, []
+    while args:
+        arg = args.pop(0)
+        if arg in VALUE_OPTIONS:
+            values[arg] = args.pop(0)
+        elif arg.startswith("-"):
+            options.add(arg)
+        else:
+            paths.append(arg)
+    src, dst = paths[-2:]
+    items = list(entries(src))
+    selected = None
+    if "--files-from" in values:
+        with open(values["--files-from"], "rb") as ifp:
+            data = ifp.read().decode(errors="surrogateescape")
+        selected = [name for name in data.split("\\0" if "--from0" in options else "\\n") if name]
+        items = [(kind, name) for kind, name in items if name in selected]
+    log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rsync.log")
+    with open(log, "a", errors="surrogateescape") as ofp:
+        ofp.write(json.dumps(dict(args=sys.argv[1:], files=selected)) + "\\n")
+
+    failed = False
+    for kind, name in items:
+        source, target = os.path.join(src, name), os.path.join(dst, name)
+        if kind == "d":
+            if "--list-only" in options:
+                print(f"drwxr-xr-x {4096:>14,} 2024/01/01 00:00:00 {escape(name)}")
+            elif not os.path.isdir(target):
+                if "--dry-run" not in options:
+                    os.makedirs(target)
+                if "--out-format" in values:
+                    print(f"~cd+++++++++ 4,096 {escape(name)}/")
+            continue
+        stat = os.stat(source)
+        if "--list-only" in options:
+            print(f"-rw-r--r-- {stat.st_size:>14,} 2024/01/01 00:00:00 {escape(name)}")
+            continue
+        if os.path.exists(target):
+            if "--ignore-existing" in options:
+                continue
+            current = os.stat(target)
+            if (current.st_size, int(current.st_mtime)) == (stat.st_size, int(stat.st_mtime)):
+                continue
+        if "--dry-run" not in options:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+            failed = failed or os.path.basename(name).startswith("fail")
+        if "--out-format" in values:
+            print(f"~>f+++++++++ {stat.st_size:,} {escape(name)}")
+    if failed:
+        print("stub rsync failure", file=sys.stderr)
+        return 23
+    return 0
+
+
+sys.exit(main(sys.argv[1:]))
+"""
+
+
+@pytest.fixture
+def stub_rsync(tmp_path, monkeypatch):
+    """run transfers with an rsync stand-in, returning a function reading its logged calls"""
+    script = tmp_path / "stub" / "rsync"
+    script.parent.mkdir()
+    script.write_text(f"#!{sys.executable}\n" + STUB_RSYNC)
+    script.chmod(0o755)
+    module = importlib.import_module("cptree.cptree")
+    which = module.which
+    monkeypatch.setattr(
+        module, "which", lambda command, *args, **kwargs: str(script) if command == "rsync" else which(command, *args, **kwargs)
+    )
+
+    def _calls():
+        log = script.parent / "rsync.log"
+        if not log.exists():
+            return []
+        return [json.loads(line) for line in log.read_text(errors="surrogateescape").splitlines()]
+
+    return _calls
@@ -0,0 +1,71 @@
+# checksum cache tests
+
+import os
+import time
+
+import pytest
+
+from cptree.cache import CACHE_FILE, ChecksumCache, cache_file
+from cptree.checksum import local_checksum
+from cptree.cptree import cptree
+
+HASHES = ["sha256"]
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    old = time.time() - 3600
+    for name in ["a", "b", "c"]:
+        (src / name).write_text(name)
+        os.utime(src / name, (old, old))
+    return src
+
+
+def _checksum(tree, cache, output):
+    with output.open("w") as ofp:
+        local_checksum(tree, HASHES, [ofp], lambda name: None, None, cache)
+    return sorted(output.read_text().split("\n"))
+
+
+def test_cache_hits(tree, tmp_path):
+    with ChecksumCache(tmp_path / "cache") as cache:
+        first = _checksum(tree, cache, tmp_path / "first")
+        assert cache.miss_count == 3
+    with ChecksumCache(tmp_path / "cache") as cache:
+        second = _checksum(tree, cache, tmp_path / "second")
+        assert cache.hit_count == 3
+        assert cache.miss_count == 0
+    assert first == second
+
+
+def test_cache_stale(tree, tmp_path):
+    with ChecksumCache(tmp_path / "cache") as cache:
+        _checksum(tree, cache, tmp_path / "first")
+    (tree / "b").write_text("changed")
+    with ChecksumCache(tmp_path / "cache") as cache:
+        lines = _checksum(tree, cache, tmp_path / "second")
+        assert cache.hit_count == 2
+        assert cache.miss_count == 1
+    with ChecksumCache(tmp_path / "nocache") as cache:
+        assert lines == _checksum(tree, cache, tmp_path / "third")
+
+
+def test_cache_evict(tree, tmp_path):
+    with ChecksumCache(tmp_path / "cache") as cache:
+        _checksum(tree, cache, tmp_path / "first")
+    with ChecksumCache(tmp_path / "cache", max_age=-1) as cache:
+        pass
+    with ChecksumCache(tmp_path / "cache") as cache:
+        _checksum(tree, cache, tmp_path / "second")
+        assert cache.hit_count == 0
+
+
+def test_cache_next_to_output_dir(tree, tmp_path, stub_rsync):
+    output_dir = tmp_path / "output"
+    ret = cptree(str(tree) + "/", str(tmp_path / "dst"), create=True, hash="sha256", output_dir=output_dir, cache=True)
+    assert ret == 0
+    assert cache_file(output_dir) == tmp_path / f"output.{CACHE_FILE}"
+    assert cache_file(output_dir).is_file()
+    assert not any(name.name.startswith(CACHE_FILE) for name in output_dir.iterdir())
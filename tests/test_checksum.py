@@ -1,12 +1,20 @@
 # checksum test cases
 
+import io
+import json
 import subprocess
 
 import pytest
 from invoke import run
 
-from cptree.checksum import checksum
+import cptree.checksum as checksum_module
+from cptree.checksum import NameFilter, checksum, checksums, compare_digests
+from cptree.common import resolver
 from cptree.cptree import cptree
+from cptree.exceptions import ChecksumGenerationFailed
+from cptree.exclude import exclude_filter
+from cptree.hashing import walk_files
+from cptree.inventory import Inventory
 
 HASH = "sha256"
 
@@ -39,6 +47,15 @@ def test_checksum_local_src(local_src, local_dst, output_dir, compare_checksums,
     assert compare_checksums(test_sums)
 
 
+def test_checksum_local_src_file_list(local_src, output_dir, compare_checksums, kwargs):
+    inventory = Inventory()
+    for name in walk_files(local_src):
+        inventory.add("-", 0, name[2:])
+    files = inventory.files()
+    test_sums = checksum(local_src, HASH, output_dir / f"local.list.{HASH}", kwargs, src=True, files=files)
+    assert compare_checksums(test_sums)
+
+
 def test_checksum_local_dst(local_src, local_dst, output_dir, compare_checksums, kwargs):
     assert cptree(local_src, local_dst, delete="force-no-countdown", hash=None) == 0
     test_sums = checksum(local_dst, HASH, output_dir / f"local.dst.{HASH}", kwargs, dst=True)
@@ -55,3 +72,99 @@ def test_checksum_remote_dst(local_src, remote_dst, output_dir, compare_checksum
     assert cptree(local_src, remote_dst, delete="force-no-countdown", hash=None) == 0
     test_sums = checksum(remote_dst + "/", HASH, output_dir / f"remote.dst.{HASH}", kwargs, dst=True)
     assert compare_checksums(test_sums)
+
+
+@pytest.mark.parametrize("python", [True, False])
+def test_checksum_agent(local_src, output_dir, local_connections, python):
+    hashes = ["sha256", "sha256-tree", "sha256-sampled", "stat"] if python else ["sha256", "stat"]
+    host = f"agent-{python}"
+    if not python:
+        resolver.remember(host, {"python3": None})
+    local = checksums(local_src, hashes, [output_dir / f"local.agent.{hash}" for hash in hashes], src=True)
+    remote = checksums(
+        f"{host}:{local_src}", hashes, [output_dir / f"remote.agent.{hash}" for hash in hashes], src=True, agent=True
+    )
+    for local_sums, remote_sums in zip(local, remote):
+        assert remote_sums.read_text() == local_sums.read_text()
+    names = [name for name in walk_files(local_src)][::2]
+    remote = checksums(
+        f"{host}:{local_src}",
+        hashes,
+        [output_dir / f"remote.list.{hash}" for hash in hashes],
+        src=True,
+        files=names,
+        agent=True,
+    )
+    assert len(remote[0].read_text().splitlines()) == len(names)
+
+
+@pytest.mark.parametrize("agent", [True, False])
+def test_checksum_remote_exclude(local_src, output_dir, local_connections, agent):
+    rsync_args = "--exclude '*.md' --include 'b*/' --exclude '*/'"
+    local = checksum(local_src, HASH, output_dir / "local.exclude", rsync_args=rsync_args, src=True)
+    remote = checksum(
+        f"exclude-{agent}:{local_src}", HASH, output_dir / "remote.exclude", rsync_args=rsync_args, src=True, agent=agent
+    )
+    assert remote.read_text() == local.read_text()
+    assert ".md)" not in local.read_text()
+
+
+@pytest.mark.parametrize("hash", ["sha256-tree", "sha256-sampled"])
+def test_checksum_remote_agent_only(local_src, output_dir, local_connections, hash):
+    hashes = [hash, "md5"]
+    local = checksums(local_src, hashes, [output_dir / f"local.tree.{hash}" for hash in hashes], src=True)
+    remote = checksums(f"tree:{local_src}", hashes, [output_dir / f"remote.tree.{hash}" for hash in hashes], src=True)
+    for local_sums, remote_sums in zip(local, remote):
+        assert remote_sums.read_text() == local_sums.read_text()
+    resolver.remember("nopython", {"python3": None})
+    with pytest.raises(ChecksumGenerationFailed):
+        checksum(f"nopython:{local_src}", hash, output_dir / "remote.tree.fail", src=True)
+
+
+def test_checksum_remote_batches(local_src, output_dir, local_connections, monkeypatch, count):
+    monkeypatch.setattr(checksum_module, "HASH_BATCH_SIZE", 1)
+    local = checksum(local_src, HASH, output_dir / "local.batches", src=True)
+    remote = checksum(f"batches:{local_src}", HASH, output_dir / "remote.batches", src=True)
+    assert remote.read_text() == local.read_text()
+    assert len(remote.read_text().splitlines()) == count
+
+
+def test_checksum_remote_empty(local_src, output_dir, local_connections):
+    remote = checksum(f"empty:{local_src}", HASH, output_dir / "remote.empty", src=True, files=[])
+    assert remote.read_text() == ""
+
+
+def test_checksum_remote_stat_escaped(tmp_path, output_dir, local_connections):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "back\\slash").write_text("escaped")
+    (src / "new\nline").write_text("escaped")
+    (src / "plain").write_text("plain")
+    local = checksum(str(src), "stat", output_dir / "local.stat", src=True)
+    remote = checksum(f"stat:{src}", "stat", output_dir / "remote.stat", src=True)
+    assert remote.read_text() == local.read_text()
+    assert "\\STAT (./new\\nline) = " in local.read_text()
+
+
+def test_name_filter():
+    out_stream = io.BytesIO()
+    name_filter = NameFilter(out_stream, exclude_filter("--exclude '*.md' --exclude build/"))
+    data = b"./a.py\0./README.md\0./build/x.py\0./docs/b.py\0"
+    for index in range(0, len(data), 5):
+        name_filter.write(data[index : index + 5])  # noqa: E203
+    name_filter.write(b"")
+    assert out_stream.getvalue() == b"./a.py\0./docs/b.py\0"
+
+
+def test_compare_digests(tmp_path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.write_text("SHA256 (./a) = 01\nSHA256 (./b) = 02\nSHA256 (./c) = 03\n\\SHA256 (./d\\nx) = 04\n")
+    dst.write_text("SHA256 (./a) = 01\nSHA256 (./b) = ff\nSHA256 (./e) = 05\n\\SHA256 (./d\\nx) = 04\n")
+    report = tmp_path / "report.jsonl"
+    counts = compare_digests(src, dst, report)
+    assert counts == dict(matched=2, missing=1, extra=1, mismatched=1)
+    records = [json.loads(line) for line in report.read_text().strip().split("\n")]
+    assert dict(status="mismatched", path="./b", src="02", dst="ff") in records
+    assert dict(status="missing", path="./c", src="03") in records
+    assert dict(status="extra", path="./e", dst="05") in records
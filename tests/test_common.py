@@ -0,0 +1,56 @@
+# command resolver tests
+
+import pytest
+
+import cptree.common
+from cptree.common import CommandResolver, resolver, which
+from cptree.exceptions import CommandNotFound
+from cptree.process import run
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    commands = []
+
+    def _run(command, **kwargs):
+        commands.append(command)
+        return run(command, **kwargs)
+
+    monkeypatch.setattr(cptree.common, "run", _run)
+    return commands
+
+
+def test_resolve_one_probe(probes):
+    commands = CommandResolver().resolve(["sort", "find", "cptree-no-such-command"])
+    assert commands["sort"].endswith("/sort")
+    assert commands["find"].endswith("/find")
+    assert commands["cptree-no-such-command"] is None
+    assert len(probes) == 1
+
+
+def test_resolve_memoized(probes):
+    resolver = CommandResolver()
+    resolver.resolve(["sort"])
+    resolver.resolve(["sort", "find"])
+    resolver.resolve(["find", "sort"])
+    assert len(probes) == 2
+
+
+def test_resolve_cache_file(probes, tmp_path):
+    cache_file = tmp_path / "commands.json"
+    sort = CommandResolver(cache_file, ttl=60).resolve(["sort"])["sort"]
+    assert cache_file.is_file()
+    assert CommandResolver(cache_file, ttl=60).resolve(["sort"])["sort"] == sort
+    assert len(probes) == 1
+    CommandResolver(cache_file, ttl=60).invalidate()
+    CommandResolver(cache_file, ttl=60).resolve(["sort"])
+    assert len(probes) == 2
+
+
+def test_resolve_invalidate_not_found():
+    which("sort")
+    assert None in resolver.hosts
+    run("exit 127", warn=True)
+    assert None not in resolver.hosts
+    with pytest.raises(CommandNotFound):
+        which("cptree-no-such-command")
@@ -1,10 +1,22 @@
 # directory tests
 
+import importlib
+import threading
+
 import pytest
 from invoke import run
 
-from cptree import cptree
-from cptree.exceptions import InvalidDirectory, RsyncTransferFailed
+from cptree import cptree, hashing
+from cptree.common import resolver
+from cptree.cptree import _content_changed, _rsync_unescape
+from cptree.exceptions import (
+    ChecksumCompareFailed,
+    ChecksumGenerationFailed,
+    InvalidDirectory,
+    RsyncTransferFailed,
+    UnsupportedRsyncArgument,
+)
+from cptree.inventory import SHARD_LARGE_SIZE, Inventory
 
 
 @pytest.fixture(autouse=True)
@@ -24,6 +36,202 @@ def test_cp_local_local(local_src, local_dst):
     assert ret == 0
 
 
+def test_cp_local_local_concurrent_hash(local_src, local_dst):
+    ret = cptree(local_src, local_dst, create=True, delete="force-no-countdown", concurrent_hash=True)
+    assert ret == 0
+
+
+def test_cp_failed_transfer_stops_concurrent_hash(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.mkdir()
+    for index in range(50):
+        (src / f"file{index}").write_text(str(index))
+    fail = tmp_path / "rsync"
+    fail.write_text("#!/bin/sh\nexit 23\n")
+    fail.chmod(0o755)
+    monkeypatch.setattr(importlib.import_module("cptree.cptree"), "which", lambda *args, **kwargs: str(fail))
+
+    module = importlib.import_module("cptree.cptree")
+    cancelled = []
+    finished = threading.Event()
+    checksums = module._checksums
+
+    def _checksums(*args, **kwargs):
+        cancelled.append(kwargs["cancel"])
+        try:
+            return checksums(*args, **kwargs)
+        finally:
+            finished.set()
+
+    hashed = []
+    hash_file = hashing.hash_file
+
+    # each hash blocks until the failed transfer cancels the run
+    def _hash_file(path, hashes, use_mmap=None):
+        assert cancelled[0].wait(10)
+        hashed.append(path)
+        return hash_file(path, hashes, use_mmap)
+
+    monkeypatch.setattr(module, "_checksums", _checksums)
+    monkeypatch.setattr(hashing, "hash_file", _hash_file)
+    monkeypatch.setattr(hashing, "default_workers", lambda: 2)
+
+    with pytest.raises(RsyncTransferFailed):
+        cptree(
+            str(src) + "/",
+            str(tmp_path / "dst"),
+            create=True,
+            hash="sha256",
+            concurrent_hash=True,
+            prescan_engine="native",
+            progress=False,
+        )
+    assert finished.wait(10)
+    assert len(hashed) <= 2 * hashing.QUEUE_DEPTH
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    for index in range(20):
+        (src / f"file{index}").write_text(str(index))
+        (src / "sub" / f"file{index}").write_text(str(index) * 100)
+    return src
+
+
+@pytest.mark.parametrize("engine", ["rsync", "native"])
+def test_cp_pipeline(tree, stub_rsync, capsys, engine):
+    ret = cptree(
+        str(tree) + "/",
+        str(tree.parent / "dst"),
+        create=True,
+        hash="sha256",
+        prescan_engine=engine,
+        pipeline=True,
+        progress=False,
+        output_dir=tree.parent / "output",
+    )
+    assert ret == 0
+    out = capsys.readouterr().out
+    assert "Scanning during transfer" in out
+    assert "Scanned 42 items: [directories=2, files=40]" in out
+    assert "Verified matching SHA256 checksums on 40 files" in out
+    assert len((tree.parent / "output" / "cptree.files").read_text().splitlines()) == 40
+    assert sorted(path.name for path in (tree.parent / "dst").rglob("*")) == sorted(
+        path.name for path in tree.rglob("*")
+    )
+
+
+def test_cp_delta_pipeline(tree, stub_rsync, capsys):
+    ret = cptree(
+        str(tree) + "/",
+        str(tree.parent / "dst"),
+        create=True,
+        hash="sha256",
+        prescan_engine="delta",
+        pipeline=True,
+        progress=False,
+    )
+    assert ret == 0
+    captured = capsys.readouterr()
+    assert "disabling --pipeline" in captured.err
+    assert "Verified matching SHA256 checksums on 40 transferred files" in captured.out
+    assert ["--dry-run" in call["args"] for call in stub_rsync()] == [True, False]
+
+
+def _parallel(tree, **kwargs):
+    return cptree(
+        str(tree) + "/", str(tree.parent / "dst"), create=True, hash="sha256", parallel=3, progress=False, **kwargs
+    )
+
+
+def test_cp_parallel(tree, stub_rsync, monkeypatch, capsys):
+    monkeypatch.setattr(Inventory.shard, "__defaults__", (SHARD_LARGE_SIZE, 5))
+    assert _parallel(tree) == 0
+    assert "Verified matching SHA256 checksums on 40 files" in capsys.readouterr().out
+    prescan_call, *shard_calls = stub_rsync()
+    assert prescan_call["files"] is None
+    assert len(shard_calls) == 3
+    # shards finish in any order; put them back in shard order
+    shard_calls.sort(key=lambda call: call["args"][call["args"].index("--files-from") + 1])
+    assert all("--from0" in call["args"] for call in shard_calls)
+    shards = [call["files"] for call in shard_calls]
+    assert all(shards)
+    assert {".", "sub"} <= set(shards[0])
+    names = [name for shard in shards for name in shard]
+    assert len(names) == len(set(names)) == 42
+    assert {name for name in names if name.startswith("sub/")} == {f"sub/file{index}" for index in range(20)}
+
+
+def test_cp_parallel_failed_shard(tree, stub_rsync, monkeypatch):
+    monkeypatch.setattr(Inventory.shard, "__defaults__", (SHARD_LARGE_SIZE, 5))
+    (tree / "sub" / "fail").write_text("fail")
+    with pytest.raises(RsyncTransferFailed, match="23"):
+        _parallel(tree)
+    assert len(stub_rsync()) == 4
+
+
+def test_cp_parallel_rejected_args(tree, stub_rsync):
+    with pytest.raises(UnsupportedRsyncArgument):
+        _parallel(tree, rsync_args="--delete-after")
+    assert stub_rsync() == []
+
+
+def test_content_changed():
+    assert _content_changed(">f+++++++++")
+    assert _content_changed("<f.st......")
+    assert _content_changed("cf+++++++++")
+    assert _content_changed("hf+++++++++")
+    assert not _content_changed(".f..t......")
+    assert not _content_changed("cd+++++++++")
+    assert not _content_changed("cL+++++++++")
+    assert not _content_changed("*deleting")
+
+
+def test_rsync_unescape():
+    assert _rsync_unescape("plain name") == "plain name"
+    assert _rsync_unescape("new\\#012line") == "new\nline"
+    assert _rsync_unescape("back\\slash") == "back\\slash"
+    assert _rsync_unescape("tab\\#011\\#377") == "tab\t\udcff"
+
+
+def _incremental(tree, **kwargs):
+    return cptree(
+        str(tree) + "/", str(tree.parent / "dst"), create=True, hash="sha256", incremental=True, progress=False, **kwargs
+    )
+
+
+def test_cp_incremental(tree, stub_rsync, capsys):
+    (tree / "new\nline").write_text("escaped")
+    (tree / "back\\slash").write_text("escaped")
+    assert _incremental(tree) == 0
+    assert "Verified matching SHA256 checksums on 42 changed files" in capsys.readouterr().out
+
+    (tree / "sub" / "file3").write_text("changed")
+    (tree / "new\nline").write_text("changed again")
+    assert _incremental(tree) == 0
+    out = capsys.readouterr().out
+    assert "Verified matching SHA256 checksums on 2 changed files" in out
+    assert "Verified matching STAT checksums on 40 unchanged files" in out
+
+
+def test_cp_incremental_damaged_unchanged_file(tree, stub_rsync):
+    assert _incremental(tree) == 0
+    (tree.parent / "dst" / "sub" / "file3").write_text("damaged")
+    with pytest.raises(ChecksumCompareFailed):
+        _incremental(tree, rsync_args="--ignore-existing")
+
+
+@pytest.mark.parametrize("hash, verify_level", [("sha256-tree", "full"), ("sha256", "sampled")])
+def test_cp_remote_hash_checked_before_transfer(tree, stub_rsync, local_connections, hash, verify_level):
+    resolver.remember("nopython", {"python3": None})
+    dst = f"nopython:{tree.parent / 'dst'}"
+    with pytest.raises(ChecksumGenerationFailed):
+        cptree(str(tree) + "/", dst, create=True, hash=hash, verify_level=verify_level, progress=False)
+    assert stub_rsync() == []
+
+
 def test_cp_local_remote(local_src, remote_dst):
     ret = cptree(local_src, remote_dst, create=True, delete="force-no-countdown")
     assert ret == 0
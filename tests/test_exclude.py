@@ -0,0 +1,48 @@
+# rsync filter rule tests
+
+import pytest
+
+from cptree.exclude import exclude_filter, rsync_filter_rules
+
+
+@pytest.mark.parametrize(
+    "args, name, excluded",
+    [
+        ("--exclude '*.o'", "./a/b.o", True),
+        ("--exclude '*.o'", "./a/b.c", False),
+        ("--exclude 'docs/*'", "./docs/index.rst", True),
+        ("--exclude 'docs/*'", "./src/docs/index.rst", True),
+        ("--exclude 'docs/*'", "./docs/", False),
+        ("--exclude '/docs/*'", "./src/docs/index.rst", False),
+        ("--exclude 'a/*/c'", "./a/b/x/c", False),
+        ("--exclude 'a/**/c'", "./a/b/x/c", True),
+        ("--exclude 'build/'", "./build/", True),
+        ("--exclude 'build/'", "./build", False),
+        ("--exclude 'cache/***'", "./cache/", True),
+        ("--exclude 'cache/***'", "./cache/x/y", True),
+        ("--exclude 'file[0-9]'", "./file7", True),
+        ("--exclude 'file[!0-9]'", "./file7", False),
+        ("--exclude 'file?'", "./file/", False),
+        ("--include 'keep.o' --exclude '*.o'", "./keep.o", False),
+        ("--exclude '*.o' --include 'keep.o'", "./keep.o", True),
+        ("--exclude='- *.tmp'", "./x.tmp", True),
+        ("--exclude '+ x.tmp' --exclude '*.tmp'", "./x.tmp", False),
+    ],
+)
+def test_exclude_rules(args, name, excluded):
+    assert exclude_filter(args)(name) == excluded
+
+
+def test_exclude_parent_directories():
+    exclude = exclude_filter("--exclude 'tests/'")
+    assert not exclude("./tests/data")
+    assert exclude.excludes_path("./tests/data")
+    assert not exclude.excludes_path("./src/tests")
+
+
+def test_exclude_from(tmp_path):
+    rules = tmp_path / "rules"
+    rules.write_text("# comment\n; comment\n\n*.log\n+ keep.log\n")
+    args = f"--include-from {rules} --exclude-from {rules} --exclude x"
+    assert rsync_filter_rules(args) == [("+", "*.log"), ("+", "keep.log"), ("-", "*.log"), ("+", "keep.log"), ("-", "x")]
+    assert exclude_filter("--include '*.c'") is None
@@ -0,0 +1,99 @@
+# in-process hashing engine tests
+
+import hashlib
+import subprocess
+
+import pytest
+
+from cptree import hashing
+from cptree.hashing import hash_files, tag_line, walk_files
+
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "empty").write_bytes(b"")
+    (tmp_path / "sub" / "data").write_bytes(b"x" * 3000000)
+    (tmp_path / "sub" / "back\\slash").write_text("escaped")
+    (tmp_path / "sub" / "new\nline").write_text("escaped")
+    (tmp_path / "link").symlink_to("empty")
+    return tmp_path
+
+
+def _reference(dir, hash):
+    cmd = f"cd {str(dir)}; find . -type f -exec {hash}sum --tag {{}} \\; | sort"
+    return subprocess.check_output(cmd, shell=True, text=True).strip().split("\n")
+
+
+@pytest.mark.parametrize("hash", ["md5", "sha1", "sha256", "sha512"])
+def test_hashing_matches_coreutils(tree, hash):
+    lines = [tag_line(hash.upper(), name, digests[0]) for name, digests in hash_files(tree, walk_files(tree), [hash])]
+    assert sorted(lines) == sorted(_reference(tree, hash))
+
+
+def test_hashing_single_pass(tree):
+    hashes = ["md5", "sha256"]
+    lines = {hash: [] for hash in hashes}
+    for name, digests in hash_files(tree, walk_files(tree), hashes):
+        for hash, digest in zip(hashes, digests):
+            lines[hash].append(tag_line(hash.upper(), name, digest))
+    for hash in hashes:
+        assert sorted(lines[hash]) == sorted(_reference(tree, hash))
+
+
+def test_hashing_exclude(tree):
+    names = sorted(walk_files(tree, exclude=lambda name: name.startswith("./sub/")))
+    assert names == ["./empty"]
+
+
+def _tree_reference(data, chunk_size):
+    leaves = [
+        hashlib.sha256(b"\x00" + data[offset : offset + chunk_size]).digest()  # noqa: E203
+        for offset in range(0, max(len(data), 1), chunk_size)
+    ]
+    while len(leaves) > 1:
+        level = [hashlib.sha256(b"\x01" + leaves[i] + leaves[i + 1]).digest() for i in range(0, len(leaves) - 1, 2)]
+        if len(leaves) % 2:
+            level.append(leaves[-1])
+        leaves = level
+    return leaves[0].hex()
+
+
+def test_hashing_tree(tree, monkeypatch):
+    monkeypatch.setattr(hashing, "TREE_CHUNK_SIZE", 1000000)
+    hashes = ["sha256-tree", "md5"]
+    results = dict(hash_files(tree, walk_files(tree), hashes))
+    md5 = dict((name, digests[0]) for name, digests in hash_files(tree, walk_files(tree), ["md5"]))
+    assert len(results) == 4
+    for name, (root, digest) in results.items():
+        data = (tree / name).read_bytes()
+        assert root == _tree_reference(data, 1000000)
+        assert digest == md5[name]
+
+
+def test_hashing_tree_skips_samples(tree, monkeypatch):
+    def _sample_offsets(size):
+        raise AssertionError("sampled without a sampled hash")
+
+    monkeypatch.setattr(hashing, "sample_offsets", _sample_offsets)
+    assert len(dict(hash_files(tree, walk_files(tree), ["sha256-tree"]))) == 4
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_hashing_read_modes(tree, monkeypatch, use_mmap):
+    monkeypatch.setattr(hashing, "MMAP_THRESHOLD", 4096)
+    path = tree / "sub" / "data"
+    assert hashing.hash_file(path, ["sha256"], use_mmap=use_mmap) == [hashlib.sha256(path.read_bytes()).hexdigest()]
+
+
+def test_hashing_sampled_and_stat(tree):
+    results = dict(hash_files(tree, walk_files(tree), ["sha256-sampled", "stat"]))
+    for name, (sampled, stat) in results.items():
+        data = (tree / name).read_bytes()
+        digest = hashlib.sha256(len(data).to_bytes(8, "big"))
+        for offset in hashing.sample_offsets(len(data)):
+            digest.update(data[offset : offset + hashing.SAMPLE_SIZE])  # noqa: E203
+        assert sampled == digest.hexdigest()
+        assert stat == f"{len(data)}-{int((tree / name).stat().st_mtime)}"
+    assert len(hashing.sample_offsets(3000000)) == hashing.SAMPLE_COUNT + 2
+    assert hashing.sample_offsets(100) == [0]
@@ -0,0 +1,54 @@
+# compact inventory tests
+
+import pytest
+
+from cptree.inventory import Inventory
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def inventory():
+    inventory = Inventory()
+    inventory.add("d", 4096, ".")
+    inventory.add("d", 4096, "big")
+    for index, size in enumerate([500, 300, 200, 100]):
+        inventory.add("-", size * MIB, f"big/file{index}")
+    inventory.add("d", 4096, "small")
+    for index in range(50):
+        inventory.add("-", 1000, f"small/file{index:02d}")
+    inventory.add("l", 5, "small/link")
+    return inventory
+
+
+def test_inventory_entries(inventory):
+    assert len(inventory) == 58
+    assert inventory.counts["-"] == 54
+    assert inventory[2].name == "big/file0"
+    assert inventory[2].size == 500 * MIB
+    assert inventory[-1].type == "l"
+    assert sum(1 for _ in inventory.files()) == 54
+    with pytest.raises(IndexError):
+        inventory[58]
+
+
+def test_inventory_shard_balance(inventory):
+    shards = inventory.shard(2, large_size=64 * MIB, batch_size=10)
+    loads = [0, 0]
+    for entry, shard in zip(inventory, shards):
+        if entry.type == "-":
+            loads[shard] += entry.size
+        else:
+            assert shard == 0
+    assert abs(loads[0] - loads[1]) <= 100 * MIB
+    small = [shard for entry, shard in zip(inventory, shards) if entry.name.startswith("small/file")]
+    assert all(small[index] == small[index - index % 10] for index in range(len(small)))
+
+
+def test_inventory_write_shard(inventory, tmp_path):
+    shards = inventory.shard(3)
+    names = []
+    for shard in range(3):
+        inventory.write_shard(tmp_path / f"shard{shard}", shards, shard)
+        names.extend((tmp_path / f"shard{shard}").read_bytes().split(b"\0")[:-1])
+    assert sorted(names) == sorted(entry.name.encode() for entry in inventory)
@@ -0,0 +1,41 @@
+# host preflight tests
+
+import pytest
+
+import cptree.preflight
+from cptree.common import CommandResolver
+from cptree.exceptions import InvalidDirectory
+from cptree.preflight import preflight
+from cptree.process import run
+from cptree.verify import verify_directories
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    monkeypatch.setattr(cptree.preflight, "resolver", CommandResolver())
+    commands = []
+
+    def _run(command, **kwargs):
+        commands.append(command)
+        return run(command, **kwargs)
+
+    monkeypatch.setattr(cptree.preflight, "run", _run)
+    return commands
+
+
+def test_preflight_one_round_trip(probes, tmp_path):
+    result = preflight(None, [tmp_path, tmp_path / "missing"], ["sort", "cptree-no-such-command"])
+    assert len(probes) == 1
+    assert result.dirs == {str(tmp_path): True, str(tmp_path / "missing"): False}
+    assert result.commands["sort"].endswith("/sort")
+    assert result.commands["cptree-no-such-command"] is None
+    assert preflight(None, commands=["sort"]).commands == {}
+    assert len(probes) == 1
+
+
+def test_preflight_verify_directories(probes, tmp_path):
+    (tmp_path / "src").mkdir()
+    verify_directories(f"{tmp_path}/src/", tmp_path / "dst", tmp_path, commands={None: ["sort"]})
+    assert len(probes) == 1
+    with pytest.raises(InvalidDirectory):
+        verify_directories(f"{tmp_path}/missing/", tmp_path / "dst", tmp_path)
@@ -0,0 +1,113 @@
+# streaming prescan tests
+
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from cptree.cptree import prescan
+from cptree.exceptions import UnrecognizedRsyncPrescanOutput
+from cptree.inventory import Inventory
+
+LISTING = """\
+drwxr-xr-x          4,096 2024/01/01 12:00:00 .
+-rw-r--r--          1,000 2024/01/01 12:00:00 a
+drwxr-xr-x          4,096 2024/01/01 12:00:00 sub
+-rw-r--r--             24 2024/01/01 12:00:00 sub/name with spaces
+lrwxrwxrwx              1 2024/01/01 12:00:00 link -> a
+"""
+
+
+@pytest.fixture
+def fake_rsync(tmp_path):
+    def _fake_rsync(listing, rc=0):
+        (tmp_path / "listing").write_text(listing)
+        script = tmp_path / "rsync"
+        script.write_text(f"#!/bin/sh\ncat {tmp_path / 'listing'}\necho oops >&2\nexit {rc}\n")
+        script.chmod(0o755)
+        return str(script)
+
+    return _fake_rsync
+
+
+def test_prescan_inventory(fake_rsync, tmp_path):
+    inventory = prescan("src/", "dst", fake_rsync(LISTING), "", False)
+    assert (inventory.total_size, inventory.item_count, inventory.counts["-"]) == (9217, 5, 2)
+    assert [entry.name for entry in inventory] == [".", "a", "sub", "sub/name with spaces", "link"]
+    assert inventory[-2].size == 24
+    inventory.write_files(tmp_path / "cptree.files")
+    assert (tmp_path / "cptree.files").read_text() == "./a\n./sub/name with spaces\n"
+
+
+def test_prescan_file_list(fake_rsync, tmp_path, capsys):
+    inventory = prescan("src/", "dst", fake_rsync(LISTING), "", True)
+    assert capsys.readouterr().out.split("\n")[:4] == [".", "a", "sub", "sub/name with spaces"]
+    assert inventory.item_count == 5
+    assert len(inventory) == 0
+
+
+def test_prescan_failure(fake_rsync, tmp_path, capsys):
+    with pytest.raises(SystemExit) as exc:
+        prescan("src/", "dst", fake_rsync("", rc=23), "", False)
+    assert exc.value.code == 23
+    assert "oops" in capsys.readouterr().err
+
+
+def test_prescan_unrecognized(fake_rsync, tmp_path):
+    with pytest.raises(UnrecognizedRsyncPrescanOutput):
+        prescan("src/", "dst", fake_rsync("garbage\n"), "", False)
+
+
+def test_prescan_pipelined(fake_rsync, capsys):
+    items = []
+    inventory = Inventory()
+    result = prescan("src/", "dst", fake_rsync(LISTING), "", False, "rsync", inventory, lambda *item: items.append(item))
+    assert result is inventory
+    assert items == [("d", 4096), ("-", 1000), ("d", 4096), ("-", 24), ("l", 1)]
+    assert "Scanned 5 items" in capsys.readouterr().out
+
+
+def test_prescan_cancel(fake_rsync):
+    cancel = threading.Event()
+    cancel.set()
+    inventory = prescan("src/", "dst", fake_rsync(LISTING), "", False, "rsync", None, lambda *item: None, cancel)
+    assert len(inventory) == 0
+
+
+def test_prescan_cancel_kills_listing(tmp_path):
+    (tmp_path / "listing").write_text(LISTING)
+    script = tmp_path / "rsync"
+    script.write_text(f"#!/bin/sh\necho $$ >{tmp_path / 'pid'}\ncat {tmp_path / 'listing'}\nexec sleep 30\n")
+    script.chmod(0o755)
+    cancel = threading.Event()
+    started = time.monotonic()
+    inventory = prescan("src/", "dst", str(script), "", False, "rsync", None, lambda *item: cancel.set(), cancel)
+    assert time.monotonic() - started < 10
+    assert len(inventory) == 1
+    stat = Path("/proc", (tmp_path / "pid").read_text().strip(), "stat")
+    assert not stat.exists() or stat.read_text().split()[2] == "Z"
+
+
+DELTA = """\
+~.d..t...... 4,096 ./
+~>f+++++++++ 1,000 a
+~cd+++++++++ 4,096 sub/
+~>f.st...... 24 sub/name with spaces
+~.f..t...... 500 unchanged
+~cL+++++++++ 1 link -> a
+~*deleting   500 gone
+"""
+
+
+def test_prescan_delta(fake_rsync):
+    inventory = prescan("src/", "dst", fake_rsync(DELTA), "", False, "delta")
+    assert [(entry.type, entry.size, entry.name) for entry in inventory] == [
+        ("d", 0, "."),
+        ("-", 1000, "a"),
+        ("d", 4096, "sub"),
+        ("-", 24, "sub/name with spaces"),
+        ("-", 0, "unchanged"),
+        ("l", 1, "link"),
+    ]
+    assert inventory.total_size == 5121
@@ -0,0 +1,110 @@
+# streaming process runner tests
+
+import io
+import shlex
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from cptree.common import which
+from cptree.cptree import _multiplex_rsync_args, ssh_control_dir
+from cptree.exceptions import CommandFailed
+from cptree.process import STDERR_TAIL_LINES, LineSplitter, connections, run, start
+from cptree.verify import verify_dst_directory, verify_src_directory
+
+
+class Lines:
+    def __init__(self):
+        self.lines = []
+
+    def feed_lines(self, lines):
+        self.lines.extend(line for line in lines if line)
+
+
+def test_process_capture():
+    result = run("echo hello; echo oops >&2")
+    assert result.ok
+    assert result.stdout == "hello\n"
+    assert result.stderr == "oops"
+
+
+def test_process_watchers():
+    watcher = Lines()
+    result = run("printf 'one\\ntwo\\rthree\\n\\nfour'", watchers=[watcher])
+    assert watcher.lines == ["one", "two", "three", "four"]
+    assert result.stdout == ""
+
+
+def test_process_stderr_tail():
+    result = run(f"seq {STDERR_TAIL_LINES * 10} >&2; exit 3", warn=True)
+    assert result.failed
+    assert result.return_code == 3
+    lines = result.stderr.split("\n")
+    assert len(lines) == STDERR_TAIL_LINES
+    assert lines[-1] == str(STDERR_TAIL_LINES * 10)
+
+
+def test_process_failure():
+    with pytest.raises(CommandFailed):
+        run("echo broken >&2; exit 1")
+
+
+def test_process_streams(tmp_path):
+    data = b"".join(b"line %d \xff\n" % index for index in range(100000))
+    out_stream = io.StringIO()
+    run("cat", in_stream=io.BytesIO(data), out_stream=out_stream)
+    assert out_stream.getvalue().encode(errors="surrogateescape") == data
+    assert run("wc -l", in_stream=io.StringIO("a\nb\n")).stdout.strip() == "2"
+
+
+def test_process_concurrent():
+    procs = [start(f"sleep 0.2; echo {index}") for index in range(4)]
+    assert [proc.join().stdout.strip() for proc in procs] == ["0", "1", "2", "3"]
+
+
+def test_process_cancel():
+    cancel = threading.Event()
+    proc = start("sleep 10", warn=True, cancel=cancel)
+    begin = time.monotonic()
+    cancel.set()
+    assert proc.join().failed
+    assert time.monotonic() - begin < 5
+
+
+def test_line_splitter_multibyte():
+    lines = []
+    splitter = LineSplitter(lines.extend)
+    data = "café\nnaïve".encode()
+    for index in range(len(data)):
+        splitter.feed(data[index : index + 1])  # noqa: E203
+    splitter.feed(b"", final=True)
+    assert lines == ["café", "naïve"]
+
+
+def test_process_connection_pool(local_connections, tmp_path):
+    host = "pool-test-host"
+    verify_src_directory(f"{host}:{tmp_path}")
+    verify_dst_directory(f"{host}:{tmp_path}/dst", create="force")
+    assert which("sort", host).endswith("/sort")
+    procs = [start(f"echo {index}", host) for index in range(4)]
+    assert [proc.join().stdout.strip() for proc in procs] == ["0", "1", "2", "3"]
+    assert run("wc -l", host, in_stream=io.StringIO("a\nb\n")).stdout.strip() == "2"
+    assert local_connections.opened == 1
+    connections.close()
+    run("true", host)
+    assert local_connections.opened == 2
+
+
+def test_ssh_control_dir(monkeypatch):
+    monkeypatch.delenv("RSYNC_RSH", raising=False)
+    with ssh_control_dir("/src/", "/dst") as control_dir:
+        assert control_dir is None
+        assert _multiplex_rsync_args("-a", control_dir) == "-a"
+    with ssh_control_dir("/src/", "nobody@invalid.:dst") as control_dir:
+        assert Path(control_dir).stat().st_mode & 0o777 == 0o700
+        words = shlex.split(_multiplex_rsync_args("-a", control_dir))
+        assert words[0] == "-e"
+        assert f"ControlPath={control_dir}/%C" in words[1]
+    assert not Path(control_dir).exists()
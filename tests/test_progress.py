@@ -0,0 +1,57 @@
+# progress aggregator tests
+
+import threading
+
+from cptree.progress import ProgressAggregator
+
+
+class Bar:
+    def __init__(self):
+        self.total = None
+        self.n = 0
+        self.updates = 0
+        self.desc = None
+        self.closed = False
+
+    def update(self, count):
+        self.n += count
+        self.updates += 1
+
+    def set_description(self, desc, refresh=True):
+        self.desc = desc
+
+    def close(self):
+        self.closed = True
+
+
+def test_progress_coalesced():
+    bar = Bar()
+    with ProgressAggregator(bar, rate=1 / 3600, describe=lambda items: f"[{items}]") as aggregator:
+        for _ in range(1000):
+            aggregator.update(10, items=1)
+            aggregator.add_total(10)
+        assert bar.updates == 1
+    assert bar.closed
+    assert bar.updates == 2
+    assert bar.n == 10000
+    assert bar.total == 10000
+    assert bar.desc == "[1000]"
+
+
+def test_progress_threads():
+    bar = Bar()
+    aggregator = ProgressAggregator(bar)
+
+    def _updates():
+        for _ in range(10000):
+            aggregator.update(1, items=1)
+
+    threads = [threading.Thread(target=_updates) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    aggregator.close()
+    assert bar.n == 40000
+    assert aggregator.items == 40000
+    assert bar.updates < 40000
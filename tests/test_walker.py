@@ -0,0 +1,51 @@
+# parallel directory walker tests
+
+import os
+
+import pytest
+
+from cptree.cptree import prescan
+from cptree.walker import walk_tree
+
+
+@pytest.fixture
+def tree(tmp_path):
+    src = tmp_path / "src"
+    for dir in ["a/b/c", "a/d", "skip/deep", "e"]:
+        (src / dir).mkdir(parents=True)
+    for name in ["top", "a/one", "a/b/two", "a/b/c/three", "a/d/four", "skip/deep/five", "e/six"]:
+        (src / name).write_text(name)
+    (src / "a" / "link").symlink_to("one")
+    os.mkfifo(src / "e" / "fifo")
+    return src
+
+
+def _records(tree, **kwargs):
+    return sorted(walk_tree(tree, **kwargs), key=lambda record: record[2])
+
+
+def test_walker_records(tree):
+    records = _records(tree, workers=4)
+    names = [name for _, _, name in records]
+    assert names[0] == "."
+    assert "a/b/c/three" in names
+    assert ("-", 8, "a/d/four") in records
+    assert ("l", 3, "a/link") in records
+    assert ("p", 0, "e/fifo") in records
+    assert len(records) == 17
+
+
+def test_walker_matches_serial_walk(tree):
+    assert _records(tree, workers=1) == _records(tree, workers=8)
+
+
+def test_walker_exclude(tree):
+    names = [name for _, _, name in _records(tree, exclude=lambda name: name.startswith("./skip"))]
+    assert not any(name.startswith("skip") for name in names)
+    assert "e/six" in names
+
+
+def test_native_prescan(tree):
+    inventory = prescan(str(tree) + "/", "dst", None, "--exclude skip/*", False, engine="native")
+    assert sorted(inventory.files()) == ["./a/b/c/three", "./a/b/two", "./a/d/four", "./a/one", "./e/six", "./top"]
+    assert inventory.counts["p"] == 1
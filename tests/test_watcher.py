@@ -0,0 +1,25 @@
+# rsync output watcher tests
+
+from cptree.watcher import LineWatcher
+
+
+def test_line_watcher_dispatch():
+    files, progress, other = [], [], []
+    watcher = LineWatcher(
+        file_callback=lambda *args: files.append(args),
+        progress_callback=lambda *args: progress.append(args),
+        line_callback=other.append,
+    )
+    watcher.feed_lines(
+        [
+            "~>f+++++++++ 1,234 dir/name with spaces",
+            "      1,238,099  45%  1.18MB/s    0:00:00",
+            "      2,000,000 100%  1.18MB/s    0:00:00 (xfr#1, to-chk=0/1)",
+            "~broken line",
+            "sent 1,234 bytes  received 35 bytes",
+            "",
+        ]
+    )
+    assert files == [("dir/name with spaces", 1, 1234, ">f+++++++++")]
+    assert progress == [(1238099, "45"), (761901, "100")]
+    assert other == ["~broken line", "sent 1,234 bytes  received 35 bytes"]